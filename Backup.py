@@ -0,0 +1,178 @@
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+
+# Pages copied per backup step and seconds between steps, writers are never blocked longer than a step
+backupPages = 1024
+backupSleep = 0.01
+
+backupPrefix = 'XRPLotto-backup-'
+
+
+class BackupException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def checkDatabase(path):
+
+    # Raises if the database can't be opened or is corrupt
+    connection = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+    try:
+        result = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        raise BackupException('{} is not a valid database: {}'.format(path, e))
+    finally:
+        connection.close()
+
+    if result != 'ok':
+        raise BackupException('Integrity check of {} failed: {}'.format(path, result))
+
+
+def restore(backupPath, databasePath):
+
+    # Copies a backup, compressed or not, to databasePath after checking it
+    # The lotto must be stopped, the restored file replaces the database at once
+    temporaryPath = databasePath + '.restore'
+
+    opener = gzip.open if backupPath.endswith('.gz') else open
+
+    try:
+
+        with opener(backupPath, 'rb') as source, open(temporaryPath, 'wb') as target:
+            shutil.copyfileobj(source, target)
+
+        checkDatabase(temporaryPath)
+
+    except (BackupException, OSError, EOFError) as e:
+
+        if os.path.isfile(temporaryPath):
+            os.remove(temporaryPath)
+
+        raise BackupException('Backup {} can not be restored: {}'.format(backupPath, e))
+
+    for suffix in ('-wal', '-shm'):
+        if os.path.isfile(databasePath + suffix):
+            os.remove(databasePath + suffix)
+
+    os.replace(temporaryPath, databasePath)
+
+
+class DatabaseBackup:
+    # Online backups of the lotto database, taken in background through SQLite's backup API
+    # Every backup is checked by restoring it to a temporary file, and only the last ones are kept
+
+    def __init__(self, database, directory, compress=True, retention=30):
+
+        self.database = database
+        self.directory = directory
+        self.compress = compress
+        self.retention = retention
+        self.thread = None
+
+
+    def start(self):
+
+        # Backups run in their own thread and connection, a backup still running makes the new one be skipped
+        if self.thread is not None and self.thread.is_alive():
+            print('Backup already running, skipped')
+            return
+
+        self.thread = threading.Thread(target=self.run, name='backup')
+        self.thread.start()
+
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def run(self):
+
+        try:
+            path = self.backup()
+            self.rotate()
+            print('Database backed up to {}'.format(path))
+        except (BackupException, OSError, sqlite3.Error) as e:
+            print('Database backup failed: {}'.format(e))
+
+
+    def backup(self):
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Microseconds keep backups of settlements within the same second apart
+        name = backupPrefix + datetime.datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S-%f') + '.db'
+        path = os.path.join(self.directory, name)
+        temporaryPath = path + '.tmp'
+
+        # The read transaction pins a WAL snapshot, otherwise every engine write would restart the stepped copy
+        # Committed txs still in the WAL are included, and writers go on meanwhile
+        source = sqlite3.connect('file:{}?mode=ro'.format(self.database), uri=True, isolation_level=None)
+        target = sqlite3.connect(temporaryPath)
+
+        try:
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=backupPages, sleep=backupSleep)
+            source.execute('COMMIT')
+        finally:
+            target.close()
+            source.close()
+
+        try:
+
+            if self.compress:
+
+                with open(temporaryPath, 'rb') as data, gzip.open(path + '.gz', 'wb') as compressed:
+                    shutil.copyfileobj(data, compressed)
+
+                os.remove(temporaryPath)
+                path += '.gz'
+
+            else:
+
+                os.replace(temporaryPath, path)
+
+            self.verify(path)
+
+        except Exception:
+
+            for leftover in (temporaryPath, path):
+                if os.path.isfile(leftover):
+                    os.remove(leftover)
+
+            raise
+
+        return path
+
+
+    def verify(self, path):
+
+        # The backup is restored to a temporary file, so a compressed backup is checked as it will be restored
+        with tempfile.TemporaryDirectory(dir=self.directory) as directory:
+            restore(path, os.path.join(directory, 'verify.db'))
+
+
+    def listBackups(self):
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        # Timestamped names sort by date
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.startswith(backupPrefix) and name.endswith(('.db', '.db.gz')))
+
+
+    def rotate(self):
+
+        backups = self.listBackups()
+
+        for path in backups[:max(0, len(backups) - self.retention)]:
+            os.remove(path)
@@ -2,6 +2,39 @@ from peewee import *
 
 db = SqliteDatabase(None)
 
+# WAL lets the bot read while the engine writes, full sync keeps every submitted payment record on power loss
+pragmas = {'journal_mode': 'wal',
+           'synchronous': 'full',
+           'cache_size': -64000, # KiB
+           'mmap_size': 256 * 1024 * 1024}
+
+# Seconds a connection waits for a lock held by another one before failing
+busyTimeout = 30
+
+
+def initDatabase(path, readOnly=False):
+
+    # Connections are opened once per thread and kept, the pragmas are applied when opening them
+    if readOnly:
+        # The journal mode belongs to the file, read-only connections can't set it
+        db.init('file:{}?mode=ro'.format(path), uri=True, timeout=busyTimeout,
+                pragmas={name: value for name, value in pragmas.items() if name != 'journal_mode'})
+    else:
+        db.init(path, timeout=busyTimeout, pragmas=pragmas)
+
+
+# Transaction hashes lists are stored packed, 32 bytes per hash
+hashSize = 32
+
+
+def packTXids(TXids):
+    return b''.join(bytes.fromhex(TXid) for TXid in TXids)
+
+
+def unpackTXids(data):
+    data = bytes(data)
+    return [data[i:i + hashSize].hex().upper() for i in range(0, len(data), hashSize)]
+
 
 class BaseModel(Model):
     class Meta:
@@ -11,12 +44,13 @@ class BaseModel(Model):
 class Payment(BaseModel):
     id = PrimaryKeyField()
     TXtype = TextField()
-    status = TextField()
+    status = TextField(index = True)
     destination = TextField()
     destinationTag = IntegerField(null = True)
     amount = DoubleField()
-    TXid = TextField(null = True)
+    TXid = TextField(null = True, index = True)
     ledgerIndex = IntegerField(null = True)
+    lastLedgerSequence = IntegerField(null = True) # Of the submitted tx, until validated or expired
     date = DateTimeField(null = True) # UTC timestamp
     memo = TextField()
 
@@ -25,13 +59,48 @@ class QueuedPayment(BaseModel):
     id = PrimaryKeyField()
     destination = TextField()
     amount = DoubleField()
-    paymentid = IntegerField()
+    paymentid = IntegerField(index = True)
 
 
 class Prize(QueuedPayment):
     winnerTXid = TextField()
-    participantTXids = TextField()
+    participantTXids = BlobField() # Packed by packTXids
     lastIncludedLedger = IntegerField()
+    drawSeed = TextField(null = True) # Hex, see Draw
+
+    def getParticipantTXids(self):
+        return unpackTXids(self.participantTXids)
+
+    def includesTX(self, TXid):
+
+        # Looks for the packed hash, aligned matches only, without unpacking the list
+        data = bytes(self.participantTXids)
+        key = bytes.fromhex(TXid)
+        index = data.find(key)
+
+        while index != -1:
+
+            if index % hashSize == 0:
+                return True
+
+            index = data.find(key, index + 1)
+
+        return False
+
+    @classmethod
+    def getLastIncludedTX(cls, prizeID=None):
+
+        # Only the last hash is read, of the given prize or the last one
+        query = cls.select(fn.substr(cls.participantTXids, -hashSize))
+
+        if prizeID is None:
+            query = query.order_by(cls.id.desc()).limit(1)
+        else:
+            query = query.where(cls.id == prizeID)
+
+        data = query.scalar()
+
+        return unpackTXids(data)[0] if data else None
 
 
 class Fee(QueuedPayment):
@@ -43,14 +112,60 @@ class Donation(QueuedPayment):
 
 
 class Devolution(QueuedPayment):
-    receivedTXid = TextField()
+    receivedTXid = TextField(unique = True)
 
 
 class Participant(BaseModel):
     id = PrimaryKeyField()
     address = TextField()
     amount = DoubleField()
-    prize = IntegerField()
-    TXid = TextField()
+    prize = IntegerField(index = True)
+    TXid = TextField(unique = True)
+    ledgerIndex = IntegerField(null = True)
+    date = DateTimeField(null = True)
+
+
+class PrizePool(BaseModel):
+    id = PrimaryKeyField()
+    prize = IntegerField(unique = True)
+    participants = IntegerField(default = 0)
+    balance = DoubleField(default = 0)
+    firstParticipant = IntegerField(null = True) # Participant ids
+    lastParticipant = IntegerField(null = True)
+
+
+class Ticket(BaseModel):
+    id = PrimaryKeyField()
+    address = TextField()
+    number = IntegerField(index = True)
+    TXid = TextField(unique = True)
     ledgerIndex = IntegerField(null = True)
-    date = DateTimeField(null = True)
\ No newline at end of file
+    date = DateTimeField(null = True)
+    prizeid = IntegerField(null = True, index = True) # First prize of the draw the ticket played, see ElGordo
+
+
+class LedgerTransaction(BaseModel):
+    id = PrimaryKeyField()
+    account = TextField()
+    hash = TextField(unique = True)
+    ledgerIndex = IntegerField(index = True)
+    data = TextField() # account_tx entry as JSON
+
+
+class Notification(BaseModel):
+    id = PrimaryKeyField()
+    paymentid = IntegerField()
+    channels = TextField() # Providers still to be notified, as JSON
+    links = TextField(default = '{}') # Links already created for the message, as JSON
+    status = TextField() # PENDING, SENT, FAILED
+    attempts = IntegerField(default = 0)
+    nextAttempt = DoubleField(default = 0) # Unix timestamp
+
+
+class RebuildCheckpoint(BaseModel):
+    id = PrimaryKeyField()
+    stage = TextField() # DOWNLOAD, REPLAY
+    lastProcessedTX = IntegerField(default = 0) # LedgerTransaction id
+    lastProcessedLedger = IntegerField(null = True)
+    pendingFrom = TextField(default = '{}') # First pending received LedgerTransaction id by prize, as JSON
+    prizeCounter = IntegerField(default = 0)
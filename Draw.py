@@ -0,0 +1,75 @@
+from array import array
+import bisect
+import itertools
+import random
+import secrets
+
+
+# Weighted winner draws over prize pools
+# Weights are the participation amounts in drops, so draws are exact integer arithmetic
+# Every draw is driven by its own seed: recorded with the prize, it replays the draw deterministically
+
+# Seeds are random 128 bits integers, stored as hex strings
+seedBits = 128
+
+
+def newSeed():
+    return secrets.randbits(seedBits)
+
+
+def seedToHex(seed):
+    return '{:0{}x}'.format(seed, seedBits // 4)
+
+
+def seedFromHex(seed):
+    return int(seed, 16)
+
+
+def toDrops(amount):
+    return round(amount * 1e6)
+
+
+def cumulativeWeights(amounts, cumulative=None):
+
+    # Appends the running sum of the amounts in drops, a new buffer is created unless one is given
+    if cumulative is None:
+        cumulative = array('q')
+
+    base = cumulative[-1] if cumulative else 0
+    cumulative.extend(base + weight for weight in itertools.accumulate(toDrops(amount) for amount in amounts))
+
+    return cumulative
+
+
+def pick(cumulative, seed, start=0, end=None):
+
+    # Winner index in [start, end) of the buffer: the first cumulative weight above a uniform draw
+    end = len(cumulative) if end is None else end
+    base = cumulative[start - 1] if start > 0 else 0
+    total = cumulative[end - 1] - base
+
+    if total <= 0:
+        raise ValueError('Pool without weight')
+
+    target = base + random.Random(seed).randrange(total)
+
+    return bisect.bisect_right(cumulative, target, start, end) - start
+
+
+def drawWinners(pools, seeds):
+
+    # Draws every pool in a batch: the amounts of all the pools share one cumulative buffer
+    # Returns the winner index inside each pool
+    cumulative = array('q')
+    bounds = []
+
+    for amounts in pools:
+        start = len(cumulative)
+        cumulativeWeights(amounts, cumulative)
+        bounds.append((start, len(cumulative)))
+
+    return [pick(cumulative, seed, start, end) for (start, end), seed in zip(bounds, seeds)]
+
+
+def replayDraw(amounts, seed):
+    return pick(cumulativeWeights(amounts), seed)
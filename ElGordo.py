@@ -0,0 +1,227 @@
+from peewee import *
+from DBmodels import *
+from array import array
+import bisect
+import heapq
+import random
+import Ingestion
+
+
+# Number-matching game: every ticket plays a number, the tickets closest to El Gordo's winning number share the jackpot
+# Runs in its own lotto instance, with its own account, configuration and database
+
+
+class ElGordoException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def ticketNumber(tx, maxNumber, reservedTags):
+
+    # Number played by a received tx, None if its destination tag is reserved
+    # Taken from the destination tag, or else from a memo holding just the number
+    # Txs without a valid number get one derived from their hash, so it can be checked by anyone
+    tag = tx.get('DestinationTag')
+
+    if tag in reservedTags:
+        return None
+
+    if tag is not None and 0 <= tag <= maxNumber:
+        return tag
+
+    for memo in tx.get('Memos', []):
+
+        try:
+            number = int(bytearray.fromhex(memo['Memo']['MemoData']).decode().strip())
+        except (KeyError, ValueError):
+            continue
+
+        if 0 <= number <= maxNumber:
+            return number
+
+    return int(tx['hash'], 16) % (maxNumber + 1)
+
+
+class TicketIndex:
+    # Sorted numbers of the tickets still playing, searched by bisection
+
+    def __init__(self, numbers=()):
+        self.numbers = array('l', sorted(numbers))
+
+
+    def __len__(self):
+        return len(self.numbers)
+
+
+    def update(self, numbers):
+        # Batches are merged at once, instead of inserting every number in the middle of the buffer
+        self.numbers = array('l', heapq.merge(self.numbers, sorted(numbers)))
+
+
+    def closest(self, target):
+
+        # Numbers at the minimum distance of the target: one, or two equally distant on both sides
+        if not self.numbers:
+            return []
+
+        index = bisect.bisect_left(self.numbers, target)
+        candidates = []
+
+        if index > 0:
+            candidates.append(self.numbers[index - 1])
+
+        if index < len(self.numbers):
+            candidates.append(self.numbers[index])
+
+        distance = min(abs(number - target) for number in candidates)
+
+        return sorted({number for number in candidates if abs(number - target) == distance})
+
+
+class ElGordo:
+
+    def __init__(self, lotto):
+
+        self.lotto = lotto
+        self.config = lotto.config
+        self.parameters = lotto.config['parameters']['elGordo']
+
+        # Unsettled tickets, loaded in order through the number column index
+        self.index = TicketIndex(number for number, in Ticket.select(Ticket.number)
+                                                             .where(Ticket.prizeid.is_null())
+                                                             .order_by(Ticket.number)
+                                                             .tuples())
+
+
+    def getLastProcessedLedger(self):
+        return Ticket.select(fn.MAX(Ticket.ledgerIndex)).scalar()
+
+
+    def processReceivedTransactions(self, transactions):
+
+        db.connect(reuse_if_open=True)
+
+        ticketPrice = self.parameters['ticketPrice']
+        batch = Ingestion.ReceivedBatch(Ticket)
+        numbers = []
+
+        for tx in transactions:
+
+            tx = tx['tx']
+
+            # Received txs only
+            if tx['Destination'] != self.config['accounts']['lotto']['address']:
+                continue
+
+            number = ticketNumber(tx, self.parameters['maxNumber'], self.parameters['reservedTags'])
+
+            if number is None:
+                print('Skipping tx {} due to tag {}'.format(tx['hash'], tx['DestinationTag']))
+                continue
+
+            # Deposits below the ticket price are returned, exceeding amounts too
+            amount = int(tx['Amount']) / 1e6
+            devolutionAmount = amount if amount < ticketPrice else round(amount - ticketPrice, 6)
+
+            if devolutionAmount > 0:
+                batch.addDevolution(tx, devolutionAmount, amount)
+
+            if amount < ticketPrice or batch.isKnown(tx):
+                continue
+
+            batch.add({'address': tx['Account'],
+                       'number': number,
+                       'TXid': tx['hash'],
+                       'ledgerIndex': tx['ledger_index'],
+                       'date': Ingestion.ledgerDate(tx['date'])})
+
+            numbers.append(number)
+
+            print('Added ticket {} with number {}'.format(tx['hash'], number))
+
+        batch.flush()
+
+        self.index.update(numbers)
+
+
+    def settle(self, winningNumber):
+
+        # Splits the jackpot among the tickets closest to the winning number, minus the donation
+        db.connect(reuse_if_open=True)
+
+        winningNumbers = self.index.closest(winningNumber)
+
+        if not winningNumbers:
+            raise ElGordoException('There are no tickets to settle')
+
+        winners = list(Ticket.select(Ticket.id, Ticket.address, Ticket.TXid, Ticket.number)
+                             .where((Ticket.prizeid.is_null()) & (Ticket.number.in_(winningNumbers)))
+                             .order_by(Ticket.id)
+                             .tuples())
+
+        jackpot = len(self.index) * self.parameters['ticketPrice']
+        donationAmount = float(int(self.parameters['donationFeeRatio'] * jackpot * 1e6) / 1e6)
+        prizeAmount = float(int((jackpot - donationAmount) / len(winners) * 1e6) / 1e6)
+
+        if jackpot >= (self.lotto.accountInfo['account_data']['Balance'] - self.config['parameters']['reservedXRP']):
+            raise ElGordoException('Insufficient funds')
+
+        nextIDs = {model: (model.select(fn.MAX(model.id)).scalar() or 0) + 1 for model in [Payment, Prize, Donation]}
+        rows = {model: [] for model in nextIDs}
+        lastLedger = Ticket.select(fn.MAX(Ticket.ledgerIndex)).where(Ticket.prizeid.is_null()).scalar()
+        firstPrizeID = nextIDs[Prize]
+
+        with db.atomic():
+
+            for _, address, TXid, number in winners:
+
+                prizeID = self.lotto.allocateID(nextIDs, Prize)
+                paymentID = self.lotto.allocateID(nextIDs, Payment)
+
+                rows[Payment].append({'id': paymentID,
+                                      'TXtype': 'PRIZE',
+                                      'status': 'PENDING',
+                                      'destination': address,
+                                      'destinationTag': None,
+                                      'amount': prizeAmount,
+                                      'memo': 'ZERPLOTTO.COM_PRIZE::Prize_id={}::Winning_number={}::Number={}::Winner_TX={}'
+                                              .format(prizeID, winningNumber, number, TXid)})
+
+                rows[Prize].append({'id': prizeID,
+                                    'destination': address,
+                                    'amount': prizeAmount,
+                                    'paymentid': paymentID,
+                                    'winnerTXid': TXid,
+                                    'participantTXids': packTXids([TXid]),
+                                    'lastIncludedLedger': lastLedger})
+
+                print('Prize {} for number {} prepared to be sent'.format(prizeID, number))
+
+            # A single donation for the whole jackpot, referencing the first prize
+            donationAccount = random.SystemRandom().choice(list(self.config['accounts']['donations'].keys()))
+            donation = self.config['accounts']['donations'][donationAccount]
+            paymentID = self.lotto.allocateID(nextIDs, Payment)
+
+            rows[Payment].append({'id': paymentID,
+                                  'TXtype': 'DONATION',
+                                  'status': 'PENDING',
+                                  'destination': donation['address'],
+                                  'destinationTag': donation.get('destinationTag'),
+                                  'amount': donationAmount,
+                                  'memo': 'ZERPLOTTO.COM_DONATION::Prize_id={}'.format(firstPrizeID)})
+
+            rows[Donation].append({'id': self.lotto.allocateID(nextIDs, Donation),
+                                   'destination': donation['address'],
+                                   'amount': donationAmount,
+                                   'paymentid': paymentID,
+                                   'prizeid': firstPrizeID})
+
+            # Tickets are kept for auditing, marked as played in the first prize
+            Ticket.update(prizeid=firstPrizeID).where(Ticket.prizeid.is_null()).execute()
+
+            self.lotto.insertRows(rows.items())
+
+        self.lotto.accountInfo['account_data']['Balance'] -= jackpot
+        self.index = TicketIndex()
+
+        return len(winners)
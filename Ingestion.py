@@ -0,0 +1,101 @@
+from peewee import *
+from DBmodels import *
+import datetime
+
+
+# Rows created from the received txs, shared by the games: participants of the pools or El Gordo tickets
+
+# Received txs inserted per batch
+ingestionBatchSize = 1000
+
+
+def ledgerDate(date):
+    # Close times count seconds since the XRPL epoch
+    return datetime.datetime.utcfromtimestamp(946684800 + int(date)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def insertRows(rowsByModel):
+
+    # Rows of the same model must share the same keys, insert_many takes the columns from the first one
+    insertedRows = 0
+
+    # Stay below SQLite's max number of query variables
+    for model, rows in rowsByModel:
+        for batch in chunked(rows, 100):
+            model.insert_many(batch).execute()
+
+        insertedRows += len(rows)
+        rows.clear()
+
+    return insertedRows
+
+
+class ReceivedBatch:
+    # Pending rows of the received txs of a model with a TXid column, and the devolutions they need
+    # Every batch is committed on its own, pages are downloaded between batches so no write transaction stays open across network requests
+
+    def __init__(self, model, onFlush=None):
+
+        self.model = model
+        self.onFlush = onFlush
+
+        # Load already included txs once instead of querying them for every tx
+        self.knownTXs = {TXid for TXid, in model.select(model.TXid).tuples()}
+        self.knownDevolutions = {TXid for TXid, in Devolution.select(Devolution.receivedTXid).tuples()}
+
+        # Payment ids are allocated here, so devolutions can reference them before being inserted
+        self.nextPaymentID = (Payment.select(fn.MAX(Payment.id)).scalar() or 0) + 1
+
+        self.payments = []
+        self.devolutions = []
+        self.rows = []
+        self.insertedRows = 0
+
+
+    def isKnown(self, tx):
+        return tx['hash'] in self.knownTXs
+
+
+    def addDevolution(self, tx, amount, receivedAmount):
+
+        # Returns the amount of a received tx that is not played, once per tx
+        if tx['hash'] in self.knownDevolutions:
+            return
+
+        self.payments.append({'id': self.nextPaymentID,
+                              'TXtype': 'DEVOLUTION',
+                              'status': 'PENDING',
+                              'destination': tx['Account'],
+                              'amount': amount,
+                              'memo': 'ZERPLOTTO.COM_DEVOLUTION::Received_TX={}'.format(tx['hash'])})
+
+        self.devolutions.append({'amount': amount,
+                                 'destination': tx['Account'],
+                                 'receivedTXid': tx['hash'],
+                                 'paymentid': self.nextPaymentID})
+
+        self.knownDevolutions.add(tx['hash'])
+        self.nextPaymentID += 1
+
+        print('Devolution created: {} to {} [{}]'.format(amount, tx['Account'], receivedAmount))
+
+
+    def add(self, row):
+
+        self.rows.append(row)
+        self.knownTXs.add(row['TXid'])
+
+        # Flush full batches so streamed histories are inserted in constant memory
+        if len(self.rows) >= ingestionBatchSize:
+            self.flush()
+
+
+    def flush(self):
+
+        # onFlush commits along with the batch the aggregates derived from it
+        with db.atomic():
+
+            self.insertedRows += insertRows([(Payment, self.payments), (Devolution, self.devolutions), (self.model, self.rows)])
+
+            if self.onFlush is not None:
+                self.onFlush()
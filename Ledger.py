@@ -1,38 +1,297 @@
 import asyncio
+import itertools
+import collections
+import time
+import random
 import websockets
 import json
+import TransactionRecord
+
+
+# Seconds to wait for a response before trying another server
+requestTimeout = 30
+
+# Seconds between attempts to reconnect a broken connection
+reconnectDelay = 5
+
+# Number of requests used to compute the rolling latency and error rate of a server
+statsWindow = 50
+
+# Servers above this error rate are only used when no other server is available
+maxErrorRate = 0.2
+
+# Seconds a request outcome counts in the error rate, so failing servers get tried again once their errors expire
+outcomeExpiry = 300
+
+
+# account_tx page size bounds, public servers clamp bigger limits anyway
+minPageSize = 10
+maxPageSize = 400
+
+# Page requests answered faster than fastResponse grow the page size, slower than slowResponse shrink it
+fastResponse = 1
+slowResponse = 5
+
+# Backoff bounds in seconds when the server throttles us
+minBackoff = 1
+maxBackoff = 60
+maxRetries = 10
+throttlingErrors = ('slowDown', 'tooBusy')
+
+# Ledger close times kept for binary pages, consecutive pages share their boundary ledgers
+closeTimeCacheSize = 10000
+
+
+class LedgerException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+class Connection:
+
+    def __init__(self, address, ledger):
+        self.address = address
+        self.ledger = ledger
+        self.websocket = None
+        self.reader = None
+        self.reconnecting = None
+        self.pendingRequests = {}
+        self.latencies = collections.deque(maxlen=statsWindow)
+        self.outcomes = collections.deque(maxlen=statsWindow)
+
+
+    def isOpen(self):
+        return self.websocket is not None and not self.reader.done()
+
+
+    def latency(self):
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0
+
+
+    def errorRate(self):
+
+        # Outcomes are (time, success) pairs, only the recent ones are counted
+        since = time.monotonic() - outcomeExpiry
+        outcomes = [success for timestamp, success in self.outcomes if timestamp >= since]
+
+        return outcomes.count(False) / len(outcomes) if outcomes else 0
+
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.address)
+        self.reader = self.ledger.loop.create_task(self.receive())
+
+
+    async def keepConnected(self):
+
+        # Retry until the server is back, so the connection is warm when it's needed again
+        while not self.isOpen():
+
+            try:
+                await self.connect()
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                print('Reconnection to {} failed: {}'.format(self.address, e))
+                await asyncio.sleep(reconnectDelay)
+
+        self.reconnecting = None
+
+
+    async def receive(self):
+
+        # Dispatch every response to the request waiting for its id
+        # Messages without id belong to the subscription streams
+        try:
+            async for message in self.websocket:
+
+                response = json.loads(message)
+
+                if 'id' not in response:
+                    if self is self.ledger.streamConnection:
+                        self.ledger.stream.put_nowait(response)
+                    continue
+
+                future = self.pendingRequests.pop(response['id'], None)
+
+                if future is not None and not future.done():
+                    future.set_result(response)
+
+        except websockets.exceptions.ConnectionClosed as e:
+            error = e
+
+        else:
+            error = ConnectionError('Connection to {} closed'.format(self.address))
+
+        # Fail requests still in flight
+        for future in self.pendingRequests.values():
+            if not future.done():
+                future.set_exception(error)
+
+        self.pendingRequests.clear()
+
+        # Wake up stream readers
+        if self is self.ledger.streamConnection:
+            self.ledger.stream.put_nowait(error)
+
+        if self.reconnecting is None:
+            self.reconnecting = self.ledger.loop.create_task(self.keepConnected())
+
+
+    async def send(self, data):
+        future = self.ledger.loop.create_future()
+        self.pendingRequests[data['id']] = future
+        start = time.monotonic()
+
+        try:
+            await self.websocket.send(json.dumps(data))
+            response = await asyncio.wait_for(future, requestTimeout)
+
+        except Exception:
+            self.pendingRequests.pop(data['id'], None)
+            self.outcomes.append((time.monotonic(), False))
+            raise
+
+        self.latencies.append(time.monotonic() - start)
+        self.outcomes.append((time.monotonic(), True))
+
+        return response
 
 
 class Ledger:
 
     def __init__(self, address):
-        self.address = address
+
+        # A single server or a list of them
+        self.addresses = [address] if isinstance(address, str) else list(address)
+        self.requestIds = itertools.count(1)
+        self.subscriptions = []
         self.loop = asyncio.get_event_loop()
+        self.stream = asyncio.Queue()
+        self.streamConnection = None
+        self.pageSize = 100
+        self.pagingStats = {'transactions': 0, 'pages': 0, 'throttled': 0, 'seconds': 0}
+        self.closeTimes = {}
+        self.connections = [Connection(address, self) for address in self.addresses]
         self.loop.run_until_complete(self.connect())
 
 
     async def connect(self):
-        self.websocket = await websockets.connect(self.address, ssl=True)
 
+        # Background reconnections only progress while the loop runs, their pending attempts may have timed out meanwhile
+        # They are cancelled and every closed connection is connected again right now
+        reconnections = [c.reconnecting for c in self.connections if c.reconnecting is not None]
 
-    async def send(self, data):
-        await self.websocket.send(json.dumps(data))
-        response = json.loads(await self.websocket.recv())
-        return response
+        for task in reconnections:
+            task.cancel()
 
+        await asyncio.gather(*reconnections, return_exceptions=True)
 
-    def get(self, data):
-        data = self.loop.run_until_complete(self.send(data))
+        for connection in self.connections:
+            connection.reconnecting = None
+
+        closedConnections = [c for c in self.connections if not c.isOpen()]
+        results = await asyncio.gather(*[c.connect() for c in closedConnections], return_exceptions=True)
+
+        for connection, result in zip(closedConnections, results):
+            if isinstance(result, Exception):
+                print('Connection to {} failed: {}'.format(connection.address, result))
+                connection.reconnecting = self.loop.create_task(connection.keepConnected())
+
+        if not any(c.isOpen() for c in self.connections):
+            raise ConnectionError('Unable to connect to any of {}'.format(', '.join(self.addresses)))
+
+
+    def reconnect(self):
+        self.loop.run_until_complete(self.connect())
+
+        # Stream messages from the old connection are discarded, callers must catch up after reconnecting
+        self.stream = asyncio.Queue()
+        self.streamConnection = None
+
+        # Restore subscriptions
+        if self.subscriptions:
+            self.subscribe(self.subscriptions)
+
+
+    def rankConnections(self):
+
+        # Fastest healthy servers first
+        connections = [c for c in self.connections if c.isOpen()]
+        return sorted(connections, key=lambda c: (c.errorRate() > maxErrorRate, c.latency()))
+
+
+    async def send(self, data, connection=None):
+        data = dict(data, id=next(self.requestIds))
+        connections = [connection] if connection else self.rankConnections()
+        error = ConnectionError('No connection available')
+
+        # Retry on the next server when a connection breaks
+        for connection in connections:
+
+            try:
+                return await connection.send(data)
+
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.ConnectionClosed) as e:
+                print('Request to {} failed: {}'.format(connection.address, repr(e)))
+                error = e
 
+        raise error
+
+
+    def wait(self, seconds):
+        # Sleep while background tasks (readers, reconnections) keep running
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+
+    @staticmethod
+    def result(data):
         if 'status' in data and data['status'] == 'success':
             return data['result']
         else:
             return None
 
 
+    def get(self, data):
+        data = self.loop.run_until_complete(self.send(data))
+        return self.result(data)
+
+
+    def getMany(self, requests):
+        # Pipeline all the requests over the same websocket, results keep the requests order
+        responses = self.loop.run_until_complete(asyncio.gather(*[self.send(data) for data in requests]))
+        return [self.result(data) for data in responses]
+
+
+    def subscribe(self, accounts):
+        data = {
+                "command": "subscribe",
+                "accounts": accounts
+        }
+
+        # Streams are listened from a single server to avoid duplicated messages
+        connections = self.rankConnections()
+
+        if not connections:
+            raise ConnectionError('No connection available')
+
+        connection = connections[0]
+        self.streamConnection = connection
+        result = self.result(self.loop.run_until_complete(self.send(data, connection)))
+        self.subscriptions = accounts
+
+        return result
+
+
+    def getStreamMessage(self):
+        message = self.loop.run_until_complete(self.stream.get())
+
+        if isinstance(message, Exception):
+            raise message
+
+        return message
+
+
     def getAccountInfo(self, address):
         data = {
-                "id": 1,
                 "command": "account_info",
                 "account": address
         }
@@ -40,58 +299,207 @@ class Ledger:
         return self.get(data)
 
 
-    def getAccountTransactions(self, address, ledger_index_min=-1):
+    def getAccountTransactionPages(self, address, ledger_index_min=-1, marker=None, binary=False):
 
-        transactions = []
-        index_min = ledger_index_min
+        # Yield (transactions, marker) pages following the server's marker cursor
+        # The yielded marker resumes the iteration right after its page, None means the end was reached
+        # Binary pages are decoded into compact TransactionRecords
+        stats = self.pagingStats = {'transactions': 0, 'pages': 0, 'throttled': 0, 'seconds': 0}
+        backoff = minBackoff
+        retries = 0
 
         while True:
-            
+
             data = {
-                    "id": 1,
                     "command": "account_tx",
                     "account": address,
-                    "ledger_index_min": index_min,
+                    "ledger_index_min": ledger_index_min,
                     "ledger_index_max": -1,
-                    "binary": False,
+                    "binary": binary,
                     "count": False,
-                    "limit": 100,
+                    "limit": self.pageSize,
                     "forward": True
             }
 
-            result = self.get(data)['transactions']
+            if marker is not None:
+                data['marker'] = marker
+
+            start = time.monotonic()
+            response = self.loop.run_until_complete(self.send(data))
+            elapsed = time.monotonic() - start
+
+            # Server asks us to slow down: shrink pages and retry the same page after a jittered backoff
+            if response.get('error') in throttlingErrors:
+
+                retries += 1
+
+                if retries > maxRetries:
+                    raise LedgerException('account_tx throttled {} times in a row'.format(retries))
+
+                self.pageSize = max(minPageSize, self.pageSize // 2)
+                delay = random.uniform(0, backoff)
+                backoff = min(maxBackoff, backoff * 2)
+                stats['throttled'] += 1
+
+                self.wait(delay)
+                stats['seconds'] += elapsed + delay
+                continue
 
-            if result:
+            result = self.result(response)
 
-                if len(transactions) > 0:
+            if result is None:
+                raise LedgerException('account_tx failed: {}'.format(response.get('error_message', response.get('error'))))
 
-                    # Delete duplicated txs
-                    j = 0
-                    for i in range(len(result)):
-                        if result[i]['tx']['hash'] == transactions[-1]['tx']['hash']:
-                            j = i + 1
-                            break
+            # Grow pages while the server answers fast, shrink them when it gets slow
+            if elapsed < fastResponse:
+                self.pageSize = min(maxPageSize, self.pageSize * 2)
+            elif elapsed > slowResponse:
+                self.pageSize = max(minPageSize, self.pageSize // 2)
 
-                    result = result[j:]
+            backoff = minBackoff
+            retries = 0
+            marker = result.get('marker')
+            transactions = result['transactions']
 
-                    if not result:
-                        break
+            if binary:
+                transactions = self.decodeTransactions(transactions)
 
-                # Add next txs batch
-                transactions.extend(result)
-                index_min = result[-1]['tx']['ledger_index']
+            stats['transactions'] += len(transactions)
+            stats['pages'] += 1
+            stats['seconds'] += elapsed
 
-            else:
+            yield transactions, marker
+
+            if marker is None:
                 break
 
-        return transactions
+        if stats['pages'] > 1:
+            print('Downloaded {} txs in {} pages: {} tx/s, page size {}, throttled {} times'
+                  .format(stats['transactions'], stats['pages'], self.transactionsPerSecond(),
+                          self.pageSize, stats['throttled']))
+
+
+    def decodeTransactions(self, transactions):
+
+        # Binary entries carry no date, so the close time of their ledgers is requested at once
+        closeTimes = self.getCloseTimes(sorted({tx['ledger_index'] for tx in transactions if 'date' not in tx}))
+
+        return [TransactionRecord.TransactionRecord.fromBlob(tx['tx_blob'],
+                                                             tx['ledger_index'],
+                                                             tx.get('date', closeTimes.get(tx['ledger_index'])),
+                                                             tx.get('meta'))
+                for tx in transactions]
+
+
+    def getCloseTimes(self, ledgerIndices):
+
+        # Uncached ledgers are requested at once, throttled lookups are retried after a jittered backoff as account_tx pages
+        missing = [ledgerIndex for ledgerIndex in ledgerIndices if ledgerIndex not in self.closeTimes]
+        backoff = minBackoff
+        retries = 0
+
+        while missing:
+
+            responses = self.loop.run_until_complete(asyncio.gather(*[self.send({"command": "ledger", "ledger_index": ledgerIndex})
+                                                                      for ledgerIndex in missing]))
+            throttled = []
+
+            for ledgerIndex, response in zip(missing, responses):
+
+                if response.get('error') in throttlingErrors:
+                    throttled.append(ledgerIndex)
+                    continue
+
+                result = self.result(response)
+
+                if result is None:
+                    raise LedgerException('ledger {} failed: {}'.format(ledgerIndex,
+                                                                        response.get('error_message', response.get('error'))))
+
+                self.closeTimes[ledgerIndex] = result['ledger']['close_time']
+
+            missing = throttled
+
+            if missing:
+
+                retries += 1
+
+                if retries > maxRetries:
+                    raise LedgerException('ledger lookups throttled {} times in a row'.format(retries))
+
+                self.pagingStats['throttled'] += 1
+                self.wait(random.uniform(0, backoff))
+                backoff = min(maxBackoff, backoff * 2)
+
+        closeTimes = {ledgerIndex: self.closeTimes[ledgerIndex] for ledgerIndex in ledgerIndices}
+
+        # Oldest ledgers are dropped first, pages are downloaded forward
+        for ledgerIndex in list(itertools.islice(self.closeTimes, max(0, len(self.closeTimes) - closeTimeCacheSize))):
+            del self.closeTimes[ledgerIndex]
+
+        return closeTimes
+
+
+    def transactionsPerSecond(self):
+
+        # Effective download rate of the last account_tx paging, backoffs included
+        if not self.pagingStats['seconds']:
+            return 0
+
+        return round(self.pagingStats['transactions'] / self.pagingStats['seconds'], 1)
+
+
+    def iterAccountTransactions(self, address, ledger_index_min=-1, marker=None, binary=False):
+
+        for transactions, _ in self.getAccountTransactionPages(address, ledger_index_min, marker, binary):
+            yield from transactions
+
+
+    def getAccountTransactions(self, address, ledger_index_min=-1, binary=False):
+        return list(self.iterAccountTransactions(address, ledger_index_min, binary=binary))
 
 
     def getTransaction(self, TXid):
         data = {
-                "id": 1,
                 "command": "tx",
                 "transaction": TXid
         }
 
-        return self.get(data)
\ No newline at end of file
+        return self.get(data)
+
+
+    def lookupTransactions(self, lookups):
+
+        # Looks for (TXid, minLedger, maxLedger) txs, returns the validated ledger and the raw tx responses by TXid
+        # Everything is asked to the same server, so a tx missing from a range it searched completely and validated is conclusive
+        connections = self.rankConnections()
+
+        if not connections:
+            raise ConnectionError('No connection available')
+
+        requests = [{"command": "ledger", "ledger_index": "validated"}] + \
+                   [{"command": "tx", "transaction": TXid, "min_ledger": minLedger, "max_ledger": maxLedger}
+                    for TXid, minLedger, maxLedger in lookups]
+
+        responses = self.loop.run_until_complete(asyncio.gather(*[self.send(data, connections[0]) for data in requests]))
+        validatedLedger = self.result(responses[0])
+
+        return (validatedLedger['ledger_index'] if validatedLedger else None,
+                {TXid: response for (TXid, _, _), response in zip(lookups, responses[1:])})
+
+
+    @staticmethod
+    def searchedAll(response):
+
+        # txnNotFound errors tell whether the whole requested range was available to the server
+        for data in (response, response.get('result', {}), response.get('data', {})):
+            if isinstance(data, dict) and 'searched_all' in data:
+                return data['searched_all'] is True
+
+        return False
+
+
+    def getTransactions(self, TXids):
+        data = [{"command": "tx", "transaction": TXid} for TXid in TXids]
+
+        return dict(zip(TXids, self.getMany(data)))
@@ -1,58 +1,185 @@
 from peewee import *
 from DBmodels import *
 import datetime
-import shutil
 import json
-import subprocess
 import os
 import sys
 import random
+import itertools
+import collections
+import bisect
+import sqlite3
+import concurrent.futures
+import multiprocessing
+import time
+import websockets
 import Ledger
+import TransactionCache
+import PaymentSubmitter
+import Migrations
+import Backup
+import Draw
+import Ingestion
+import ElGordo
 from Notifications import Notifications, TelegramNotifier
 
 testing = True
 
+# Replayed txs between database rebuild checkpoints
+rebuildCheckpointInterval = 10000
+
+# Cached txs per rebuild partition and number of processes classifying them
+rebuildPartitionSize = 50000
+rebuildWorkers = os.cpu_count() or 1
+
+# Seconds to wait before reconnecting in daemon mode
+reconnectDelay = 10
+
+# History fetches and seconds between them while the server pool catches up with a streamed ledger
+catchUpAttempts = 10
+catchUpInterval = 2
+
+# Max seconds a one-shot run spends sending queued notifications
+notificationTimeout = 60
+
 
 class LottoException(Exception):
     def __init__(self, message):
         Exception.__init__(self, message)
 
 
+def prizeForTX(tx, prizes, reservedTags):
+
+    # Prize a received tx plays for, None if its destination tag is reserved
+    if 'DestinationTag' in tx:
+
+        if tx['DestinationTag'] in reservedTags:
+            return None
+
+        if tx['DestinationTag'] in prizes:
+            return tx['DestinationTag']
+
+    return prizes[-1]
+
+
+def classifyPartition(database, address, prizes, reservedTags, fromPosition, toPosition):
+
+    # Decodes and classifies the cached txs between two positions, runs in the rebuild worker processes
+    # Returns (position, ledgerIndex, event) tuples, where event is None for txs irrelevant to the rebuild,
+    # ('RECEIVED', hash, prize) for tickets and ('SENT', tx, memo) for our payments
+    connection = sqlite3.connect('file:{}?mode=ro'.format(database), uri=True)
+    events = []
+
+    try:
+
+        rows = connection.execute('SELECT id, data FROM {} WHERE account = ? AND id >= ? AND id < ? ORDER BY id'
+                                  .format(LedgerTransaction._meta.table_name), (address, fromPosition, toPosition))
+
+        for position, data in rows:
+
+            tx = json.loads(data)['tx']
+            event = None
+
+            if tx['Destination'] == address:
+
+                prizeValue = prizeForTX(tx, prizes, reservedTags)
+
+                if prizeValue is not None:
+                    event = ('RECEIVED', tx['hash'], prizeValue)
+
+            # Sent txs only
+            elif tx['Account'] == address and 'Memos' in tx:
+
+                # Read the first memo and decode it
+                memo = bytearray.fromhex(tx['Memos'][0]['Memo']['MemoData']).decode()
+
+                if 'ZERPLOTTO.COM' in memo:
+                    fields = ['Destination', 'DestinationTag', 'Amount', 'hash', 'ledger_index', 'date']
+                    event = ('SENT', {field: tx[field] for field in fields if field in tx}, memo)
+
+            events.append((position, tx['ledger_index'], event))
+
+    finally:
+        connection.close()
+
+    return events
+
+
 class Lotto:
 
-    def __init__(self, config):
+    # Number-matching game, None when playing the weighted pools
+    elGordo = None
+
+    def __init__(self, config, offline=False):
 
         self.config = config
 
         # Initialize database
-        db.init(self.config['parameters']['database'])
-        db.create_tables([Prize, Fee, Donation, Devolution, Participant, Payment])
-        db.close()
+        # The connection is kept open for the whole run
+        initDatabase(self.config['parameters']['database'])
+        Migrations.migrate()
+        db.create_tables([Prize, Fee, Donation, Devolution, Participant, Payment, PrizePool, Ticket, LedgerTransaction, Notification])
+
+        # Pools aggregates of databases created before PrizePool existed
+        if not PrizePool.select().exists():
+            self.refreshPrizePools()
+
+        # Offline mode works only with the locally cached transactions
+        if offline:
+
+            self.ledger = None
+            self.accountInfo = None
+            self.notifier = None
+
+        else:
+
+            # Instantiate ledger and retrieve account info
+            self.ledger = Ledger.Ledger(self.config['parameters']['connection'])
+            self.updateAccountInfo()
+
+            # Notifications are sent from the outbox in background, sharing the ledger's event loop
+            self.notifier = Notifications.NotificationWorker(self.config, self.ledger.loop)
+
+        self.history = TransactionCache.TransactionCache(self.ledger, self.config['parameters']['binaryTransactions'])
+
+        self.backups = Backup.DatabaseBackup(self.config['parameters']['database'],
+                                             self.config['parameters']['backupDirectory'],
+                                             self.config['parameters']['backupCompression'],
+                                             self.config['parameters']['backupRetention'])
+
+        # Number-matching game instead of the weighted pools
+        self.elGordo = ElGordo.ElGordo(self) if self.config['parameters']['game'] == 'elGordo' else None
+
+        # Update transactions
+        self.getLastTransactions()
+
+
+    def updateAccountInfo(self):
 
-        # Instantiate ledger and retrieve account info
-        self.ledger = Ledger.Ledger(self.config['parameters']['connection'])
         self.accountInfo = self.ledger.getAccountInfo(self.config['accounts']['lotto']['address'])
-        self.accountInfo['account_data']['Balance'] = int(self.accountInfo['account_data']['Balance']) / 1e6
 
         if not self.accountInfo:
             raise LottoException('Error retrieving account data from XRPL')
 
-        # Update transactions
-        self.getLastTransactions()
+        self.accountInfo['account_data']['Balance'] = int(self.accountInfo['account_data']['Balance']) / 1e6
 
 
     def getLastProcessedLedger(self):
 
-        # Load participants
         db.connect(reuse_if_open=True)
+
+        # Tickets are never deleted, the last one marks the processed history
+        if self.elGordo is not None:
+            lastProcessedLedger = self.elGordo.getLastProcessedLedger()
+            return lastProcessedLedger if lastProcessedLedger is not None else -1
+
+        # Load participants
         participants = Participant.select().order_by(Participant.id)
 
         # Participant table is not empty: return last participant ledgerIndex
         if participants.count() > 0:
 
-            lastProcessedLedger = participants[-1].ledgerIndex
-            db.close()
-            return lastProcessedLedger
+            return participants[-1].ledgerIndex
 
         # Participant table is empty: use last prize's data
         else:
@@ -62,15 +189,11 @@ class Lotto:
             # Some prize has been already delivered. Return last prize ledger
             if prizes.count() > 0:
 
-                lastPrize = prizes[-1]
-                lastProcessedLedger = lastPrize.lastIncludedLedger
-                db.close()
-                return lastProcessedLedger
+                return prizes[-1].lastIncludedLedger
 
             # No prizes delivered yet
             else:
 
-                db.close()
                 return -1
 
 
@@ -83,106 +206,174 @@ class Lotto:
            (lastProcessedLedger < self.config['parameters']['startFromLedger']):
             lastProcessedLedger = self.config['parameters']['startFromLedger']
 
-        self.transactions = self.ledger.getAccountTransactions(self.config['accounts']['lotto']['address'],
-                                                               ledger_index_min = lastProcessedLedger)
-        if not self.transactions:
+        transactions = self.history.iterAccountTransactions(self.config['accounts']['lotto']['address'],
+                                                            ledger_index_min = lastProcessedLedger)
+
+        firstTX = next(transactions, None)
+
+        if not firstTX:
             raise LottoException('No new transactions received')
 
         # Delete first TX (activation) if tx history starts from the beggining
-        if lastProcessedLedger == -1:
-            self.transactions.pop(0)
+        if lastProcessedLedger != -1:
+            transactions = itertools.chain([firstTX], transactions)
 
         # Delete TXs already processed in the last prize
         # This prevents for txs included in the same ledger that the last tx included in a prize being skipped
         # As we are including 'lastProcessedLedger' as our first ledger, some already processed txs must be deleted
-        lastIncludedTXs = self.getParticipantTXsByPrizeID()
+        lastIncludedTX = Prize.getLastIncludedTX()
 
-        if lastIncludedTXs:
-            j = 0
-            for i in range(len(self.transactions)):
-                if self.transactions[i]['tx']['hash'] == lastIncludedTXs[-1]:
-                    j = i + 1
-                    break
+        if lastIncludedTX:
+            transactions = self.skipProcessedTransactions(transactions, lastIncludedTX, lastProcessedLedger)
+
+        self.transactions = transactions
+
+
+    def skipProcessedTransactions(self, transactions, lastIncludedTX, lastProcessedLedger):
+
+        # Only the txs in the last processed ledger need to be buffered to look for the last included one
+        boundaryTXs = []
+
+        for tx in transactions:
+
+            if boundaryTXs is not None:
+
+                if tx['tx']['ledger_index'] <= lastProcessedLedger:
+                    boundaryTXs.append(tx)
+                    continue
+
+                yield from self.dropUntilTX(boundaryTXs, lastIncludedTX)
+                boundaryTXs = None
+
+            yield tx
+
+        if boundaryTXs:
+            yield from self.dropUntilTX(boundaryTXs, lastIncludedTX)
+
+
+    @staticmethod
+    def dropUntilTX(transactions, TXid):
 
-            self.transactions = self.transactions[j:]
+        for i in range(len(transactions)):
+            if transactions[i]['tx']['hash'] == TXid:
+                return transactions[i + 1:]
+
+        return transactions
 
 
     def processReceivedTransactions(self):
 
+        if self.elGordo is not None:
+            return self.elGordo.processReceivedTransactions(self.transactions)
+
         db.connect(reuse_if_open=True)
 
+        start = time.monotonic()
+
+        # Participant ids are allocated here, so the prize pools aggregates can track them
+        # Pools deltas are committed along with every batch of participants
+        nextParticipantID = (Participant.select(fn.MAX(Participant.id)).scalar() or 0) + 1
+        poolDeltas = {}
+        batch = Ingestion.ReceivedBatch(Participant, lambda: self.addToPrizePools(poolDeltas))
+
         for tx in self.transactions:
 
             tx = tx['tx']
 
             # Received txs only
-            if tx['Destination'] == self.config['accounts']['lotto']['address']:
+            if tx['Destination'] != self.config['accounts']['lotto']['address']:
+                continue
 
-                # Select prize destination using tag
-                if 'DestinationTag' in tx:
+            # Select prize destination using tag
+            prize = self.selectPrize(tx)
 
-                    # Skip tx if its destination tag is one of the reserved ones
-                    if tx['DestinationTag'] in self.config['parameters']['reservedTags']:
-                        print('Skipping tx {} due to tag {}'.format(tx['hash'], tx['DestinationTag']))
-                        continue
+            # Skip tx if its destination tag is one of the reserved ones
+            if prize is None:
+                print('Skipping tx {} due to tag {}'.format(tx['hash'], tx['DestinationTag']))
+                continue
 
-                    prize = tx['DestinationTag']
+            # Calculate max allowed participation
+            participationAmount = int(tx['Amount']) / 1e6
+            maxParticipation = self.config['parameters']['maxParticipationRatio'] * prize
 
-                    if not prize in self.config['parameters']['prizes']:
-                        prize = self.config['parameters']['prizes'][-1]
-                else:
-                    prize = self.config['parameters']['prizes'][-1]
+            # Exceeded value is returned
+            if participationAmount > maxParticipation:
+                batch.addDevolution(tx, participationAmount - maxParticipation, participationAmount)
+                participationAmount = maxParticipation
 
-                # Calculate max allowed participation
-                participationAmount = int(tx['Amount']) / 1e6
-                maxParticipation = self.config['parameters']['maxParticipationRatio'] * prize
+            # Add new participant if tx has not been included yet
+            if not batch.isKnown(tx):
 
-                # Make a devolution if the received amount exceeds max and has not been included yet in Devolution
-                devolution = None
+                # (participants, balance, first id, last id) added to every prize pool
+                count, balance, firstID, _ = poolDeltas.get(prize, (0, 0, nextParticipantID, None))
+                poolDeltas[prize] = (count + 1, balance + participationAmount, firstID, nextParticipantID)
 
-                if (participationAmount > maxParticipation) and \
-                (not Devolution.select().where(Devolution.receivedTXid == tx['hash']).exists()):
+                batch.add({'id': nextParticipantID,
+                           'address': tx['Account'],
+                           'amount': participationAmount,
+                           'prize': prize,
+                           'TXid': tx['hash'],
+                           'date': Ingestion.ledgerDate(tx['date']),
+                           'ledgerIndex': tx['ledger_index']})
 
-                    memo = 'ZERPLOTTO.COM_DEVOLUTION::Received_TX={}'.format(tx['hash'])
+                nextParticipantID += 1
 
-                    payment = Payment(TXtype = 'DEVOLUTION',
-                                      status = 'PENDING',
-                                      destination = tx['Account'],
-                                      amount = participationAmount - maxParticipation,
-                                      memo = memo)
+                print("Added participant tx {}".format(tx['hash']))
 
-                    payment.save()
+        batch.flush()
 
-                    devolution = Devolution(amount = participationAmount - maxParticipation,
-                                            destination = tx['Account'],
-                                            receivedTXid = tx['hash'],
-                                            paymentid = payment.id)
+        elapsed = time.monotonic() - start
 
-                    devolution.save()
+        if batch.insertedRows:
+            print('Inserted {} rows in {:.2f} seconds ({} rows/s)'.format(batch.insertedRows, elapsed, round(batch.insertedRows / elapsed)))
 
-                    print("Devolution created: {} to {} because of exceeded value [{}]".format(devolution.amount,
-                                                                                      devolution.destination,
-                                                                                      participationAmount))
 
-                    participationAmount = maxParticipation
+    @staticmethod
+    def addToPrizePools(poolDeltas):
 
-                # Add new participant if tx has not been included yet
-                if not Participant.select().where(Participant.TXid == tx['hash']).exists():
+        for prizeValue, (count, balance, firstID, lastID) in poolDeltas.items():
 
-                    date = datetime.datetime.utcfromtimestamp( 946684800 + int(tx['date']) ).strftime('%Y-%m-%d %H:%M:%S')
+            pool, _ = PrizePool.get_or_create(prize=prizeValue)
 
-                    participant = Participant(address = tx['Account'],
-                                              amount = participationAmount,
-                                              prize = prize,
-                                              TXid = tx['hash'],
-                                              date = date,
-                                              ledgerIndex = tx['ledger_index'])
+            pool.participants += count
+            pool.balance = round(pool.balance + balance, 6)
+            pool.lastParticipant = lastID
 
-                    participant.save()
+            if pool.firstParticipant is None:
+                pool.firstParticipant = firstID
 
-                    print("Added participant tx {}".format(tx['hash']))
+            pool.save()
 
-        db.close()
+        # Deltas are consumed, the next batch starts new ones
+        poolDeltas.clear()
+
+
+    @staticmethod
+    def refreshPrizePools():
+
+        # Full aggregation of the participants, incremental updates keep it afterwards
+        pools = Participant.select(Participant.prize,
+                                   fn.COUNT(Participant.id),
+                                   fn.SUM(Participant.amount),
+                                   fn.MIN(Participant.id),
+                                   fn.MAX(Participant.id)) \
+                           .group_by(Participant.prize) \
+                           .tuples()
+
+        with db.atomic():
+
+            PrizePool.delete().execute()
+
+            for prizeValue, count, balance, firstID, lastID in pools:
+                PrizePool.create(prize=prizeValue,
+                                 participants=count,
+                                 balance=round(balance, 6),
+                                 firstParticipant=firstID,
+                                 lastParticipant=lastID)
+
+
+    # Shared with El Gordo
+    insertRows = staticmethod(Ingestion.insertRows)
 
 
     def processPrizes(self):
@@ -192,148 +383,201 @@ class Lotto:
         # Check if there are pending payments
         pendingPayments = Payment.select().where(Payment.status == 'PENDING').exists()
 
-        # Compile senders addresses and probabilities for every prize
-        for prizeValue in self.config['parameters']['prizes']:
+        # El Gordo is settled on demand, once its winning number is known
+        if self.elGordo is not None:
+            return pendingPayments
 
-            allParticipantsProcessed = False
+        # Ids are allocated up front, so every settlement row is built complete before being inserted
+        nextIDs = {model: (model.select(fn.MAX(model.id)).scalar() or 0) + 1 for model in [Payment, Prize, Fee, Donation]}
+        rows = {model: [] for model in nextIDs}
 
-            # Loop while there are enough txs to fill prizes
-            while not allParticipantsProcessed:
+        # All the prizes are settled in a single transaction
+        with db.atomic():
 
-                participants = Participant.select().where(Participant.prize == prizeValue)
-                nparticipants = len(participants)
+            # Compile senders addresses and probabilities for every prize
+            for prizeValue in self.config['parameters']['prizes']:
 
-                if nparticipants == 0:
-                    break
+                # Pools still filling are skipped without reading their participants
+                prizePool = PrizePool.get_or_none(PrizePool.prize == prizeValue)
 
-                processedParticipants = 0
+                if prizePool is None or prizePool.balance < prizeValue:
+                    continue
 
-                selectedParticipants = []
-                selectedAddresses = []
-                selectedTXs = []
-                selectedAmounts = []
-                selectedBalance = 0
-                lastIncludedLedger = 0
+                participants = Participant.select(Participant.id,
+                                                  Participant.address,
+                                                  Participant.TXid,
+                                                  Participant.amount,
+                                                  Participant.ledgerIndex) \
+                                          .where((Participant.prize == prizeValue) &
+                                                 (Participant.id >= prizePool.firstParticipant)) \
+                                          .order_by(Participant.id) \
+                                          .tuples()
 
-                for p in participants:
+                pools = self.fillPools(participants, prizeValue)
 
-                    selectedParticipants.append(p.id)
-                    selectedAddresses.append(p.address)
-                    selectedTXs.append(p.TXid)
-                    selectedAmounts.append(p.amount)
-                    selectedBalance += p.amount
-                    lastIncludedLedger = p.ledgerIndex
-                    processedParticipants += 1
-                    allParticipantsProcessed = (processedParticipants >= nparticipants)
+                if not pools:
+                    continue
 
-                    if selectedBalance >= prizeValue:
-                        break
+                # Winners of every pool are drawn at once, each draw with its own recorded seed
+                seeds = [Draw.newSeed() for _ in pools]
+                winners = Draw.drawWinners([[participant[3] for participant in pool] for pool, _ in pools], seeds)
 
-                if selectedBalance >= (self.accountInfo['account_data']['Balance'] -
-                                       self.config['parameters']['reservedXRP']):
-                    raise LottoException('Insufficient funds')
+                for (pool, balance), winnerIndex, seed in zip(pools, winners, seeds):
 
-                if selectedBalance >= prizeValue:
+                    if balance >= (self.accountInfo['account_data']['Balance'] -
+                                   self.config['parameters']['reservedXRP']):
+                        raise LottoException('Insufficient funds')
 
-                    # Select a winner address
-                    rng = random.SystemRandom()
-                    selectedIndices = list(range(len(selectedAddresses)))
-                    winnerIndex = rng.choices(selectedIndices, weights=selectedAmounts, k=1)[0]
-                    winnerAddress = selectedAddresses[winnerIndex]
-                    winnerTX = selectedTXs[winnerIndex]
+                    self.settlePrize(pool, balance, winnerIndex, seed, nextIDs, rows)
 
-                    # Calculate prize
-                    feeAmount = self.config['parameters']['platformFeeRatio'] * selectedBalance
-                    donationAmount = self.config['parameters']['donationFeeRatio'] * selectedBalance
-                    prizeAmount = selectedBalance - feeAmount - donationAmount
+                # Pools are consecutive from the first participant, so every participant up to the last settled one is consumed
+                lastSettledParticipant = pools[-1][0][-1][0]
 
-                    # Truncate ammounts to 6 decimals
-                    feeAmount = float( int(feeAmount * 1e6) / 1e6)
-                    donationAmount = float( int(donationAmount * 1e6) / 1e6)
-                    prizeAmount = float( int(prizeAmount * 1e6) / 1e6)
+                Participant.delete().where((Participant.prize == prizeValue) &
+                                           (Participant.id <= lastSettledParticipant)).execute()
 
-                    # Add prize to database
-                    payment = Payment(TXtype = 'PRIZE',
-                                      status = 'PENDING',
-                                      destination = winnerAddress,
-                                      amount = prizeAmount,
-                                      memo = '')
+                prizePool.participants -= sum(len(pool) for pool, _ in pools)
+                prizePool.balance = round(prizePool.balance - sum(balance for _, balance in pools), 6)
+                prizePool.firstParticipant = Participant.select(Participant.id) \
+                                                        .where((Participant.prize == prizeValue) &
+                                                               (Participant.id > lastSettledParticipant)) \
+                                                        .order_by(Participant.id) \
+                                                        .limit(1) \
+                                                        .scalar()
 
-                    payment.save()
+                if prizePool.firstParticipant is None:
+                    prizePool.participants = 0
+                    prizePool.balance = 0
+                    prizePool.lastParticipant = None
 
-                    prize = Prize(destination = winnerAddress,
-                                  amount = prizeAmount,
-                                  paymentid = payment.id,
-                                  winnerTXid = winnerTX,
-                                  participantTXids = str(selectedTXs)[1:-1].replace('\'','').replace(' ',''),
-                                  lastIncludedLedger = lastIncludedLedger)
-                    prize.save()
+                prizePool.save()
 
-                    payment.memo = 'ZERPLOTTO.COM_PRIZE::Prize_id={}::First_included_TX={}::Last_included_TX={}::Winner_TX={}' \
-                                   .format(prize.id, selectedTXs[0], selectedTXs[-1], winnerTX)
+                pendingPayments = True
 
-                    payment.save()
+            self.insertRows(rows.items())
 
-                    print('Prize {} prepared to be sent'.format(prize.id))
+        return pendingPayments
 
-                    # Add fee to database
-                    payment = Payment(TXtype = 'FEE',
-                                      status = 'PENDING',
-                                      destination = self.config['accounts']['fees']['address'],
-                                      amount = feeAmount,
-                                      memo = 'ZERPLOTTO.COM_FEE::Prize_id={}'.format(prize.id))
 
-                    payment.save()
+    @staticmethod
+    def fillPools(participants, prizeValue):
 
-                    fee = Fee(destination = self.config['accounts']['fees']['address'],
-                              amount = feeAmount,
-                              paymentid = payment.id,
-                              prizeid = prize.id)
+        # Single ordered pass: a pool is closed as soon as its running balance reaches the prize value
+        # Returns the completed pools as (participants, balance), the remaining participants wait for the next run
+        pools = []
+        pool = []
+        balance = 0
 
-                    fee.save()
+        for participant in participants:
 
-                    print('Fee {} prepared to be sent'.format(fee.id))
+            pool.append(participant)
+            balance += participant[3]
+
+            if balance >= prizeValue:
+                pools.append((pool, balance))
+                pool = []
+                balance = 0
 
-                    # Add donation to database
-                    donationAccount = rng.choices(list(self.config['accounts']['donations'].keys()), k=1)[0]
+        return pools
 
-                    donationAddress = self.config['accounts']['donations'][donationAccount]['address']
 
-                    payment = Payment(TXtype = 'DONATION',
-                                      status = 'PENDING',
-                                      destination = donationAddress,
-                                      amount = donationAmount,
-                                      memo = 'ZERPLOTTO.COM_DONATION::Prize_id={}'.format(prize.id))
+    @staticmethod
+    def allocateID(nextIDs, model):
+        nextIDs[model] += 1
+        return nextIDs[model] - 1
 
-                    if 'destinationTag' in self.config['accounts']['donations'][donationAccount]:
-                        payment.destinationTag = self.config['accounts']['donations'][donationAccount]['destinationTag']
 
-                    payment.save()
+    def settlePrize(self, pool, selectedBalance, winnerIndex, seed, nextIDs, rows):
 
-                    donation = Donation(destination = donationAddress,
-                                        amount = donationAmount,
-                                        paymentid = payment.id,
-                                        prizeid = prize.id)
+        # Pool participants are (id, address, TXid, amount, ledgerIndex) tuples
+        _, selectedAddresses, selectedTXs, _, _ = zip(*pool)
+        lastIncludedLedger = pool[-1][4]
 
-                    donation.save()
+        # Winner drawn with the given seed
+        winnerAddress = selectedAddresses[winnerIndex]
+        winnerTX = selectedTXs[winnerIndex]
 
-                    print('Donation {} prepared to be sent'.format(donation.id))
+        # Calculate prize
+        feeAmount = self.config['parameters']['platformFeeRatio'] * selectedBalance
+        donationAmount = self.config['parameters']['donationFeeRatio'] * selectedBalance
+        prizeAmount = selectedBalance - feeAmount - donationAmount
 
-                    # Update balance
-                    self.accountInfo['account_data']['Balance'] -= selectedBalance
+        # Truncate ammounts to 6 decimals
+        feeAmount = float( int(feeAmount * 1e6) / 1e6)
+        donationAmount = float( int(donationAmount * 1e6) / 1e6)
+        prizeAmount = float( int(prizeAmount * 1e6) / 1e6)
 
-                    # Delete processed participations
-                    Participant.delete().where(Participant.id.in_(selectedParticipants)).execute()
+        # Add prize to database
+        prizeID = self.allocateID(nextIDs, Prize)
+        paymentID = self.allocateID(nextIDs, Payment)
 
-                    pendingPayments = True
+        rows[Payment].append({'id': paymentID,
+                              'TXtype': 'PRIZE',
+                              'status': 'PENDING',
+                              'destination': winnerAddress,
+                              'destinationTag': None,
+                              'amount': prizeAmount,
+                              'memo': 'ZERPLOTTO.COM_PRIZE::Prize_id={}::First_included_TX={}::Last_included_TX={}::Winner_TX={}::Seed={}' \
+                                      .format(prizeID, selectedTXs[0], selectedTXs[-1], winnerTX, Draw.seedToHex(seed))})
 
-        if not db.is_closed():
-            try:
-                db.close()
-            except OperationalError as e:
-                pass #FIXME: exception raised on close
+        rows[Prize].append({'id': prizeID,
+                            'destination': winnerAddress,
+                            'amount': prizeAmount,
+                            'paymentid': paymentID,
+                            'winnerTXid': winnerTX,
+                            'participantTXids': packTXids(selectedTXs),
+                            'lastIncludedLedger': lastIncludedLedger,
+                            'drawSeed': Draw.seedToHex(seed)})
 
-        return pendingPayments
+        print('Prize {} prepared to be sent'.format(prizeID))
+
+        # Add fee to database
+        feeID = self.allocateID(nextIDs, Fee)
+        paymentID = self.allocateID(nextIDs, Payment)
+
+        rows[Payment].append({'id': paymentID,
+                              'TXtype': 'FEE',
+                              'status': 'PENDING',
+                              'destination': self.config['accounts']['fees']['address'],
+                              'destinationTag': None,
+                              'amount': feeAmount,
+                              'memo': 'ZERPLOTTO.COM_FEE::Prize_id={}'.format(prizeID)})
+
+        rows[Fee].append({'id': feeID,
+                          'destination': self.config['accounts']['fees']['address'],
+                          'amount': feeAmount,
+                          'paymentid': paymentID,
+                          'prizeid': prizeID})
+
+        print('Fee {} prepared to be sent'.format(feeID))
+
+        # Add donation to database
+        rng = random.SystemRandom()
+        donationAccount = rng.choices(list(self.config['accounts']['donations'].keys()), k=1)[0]
+
+        donationAddress = self.config['accounts']['donations'][donationAccount]['address']
+
+        donationID = self.allocateID(nextIDs, Donation)
+        paymentID = self.allocateID(nextIDs, Payment)
+
+        rows[Payment].append({'id': paymentID,
+                              'TXtype': 'DONATION',
+                              'status': 'PENDING',
+                              'destination': donationAddress,
+                              'destinationTag': self.config['accounts']['donations'][donationAccount].get('destinationTag'),
+                              'amount': donationAmount,
+                              'memo': 'ZERPLOTTO.COM_DONATION::Prize_id={}'.format(prizeID)})
+
+        rows[Donation].append({'id': donationID,
+                               'destination': donationAddress,
+                               'amount': donationAmount,
+                               'paymentid': paymentID,
+                               'prizeid': prizeID})
+
+        print('Donation {} prepared to be sent'.format(donationID))
+
+        # Update balance
+        self.accountInfo['account_data']['Balance'] -= selectedBalance
 
 
     def checkPayments(self):
@@ -342,271 +586,562 @@ class Lotto:
 
         print('Checking finality of payments results...')
 
-        payments = Payment.select().where( (Payment.status == 'SUCCESS_NOT_FINAL') &
-                                           (Payment.TXid.is_null(False)) )
+        pendingPayments = {payment.TXid: payment
+                           for payment in Payment.select().where( (Payment.status == 'SUCCESS_NOT_FINAL') &
+                                                                  (Payment.TXid.is_null(False)) )}
+
+        if not pendingPayments:
+            return
+
+        # Submitted payments keep their submission ledger, older ones are looked for after the last final payment
+        submissionLedgers = [payment.ledgerIndex for payment in pendingPayments.values() if payment.ledgerIndex is not None]
+
+        if len(submissionLedgers) < len(pendingPayments):
+            submissionLedgers.append(Payment.select(fn.MAX(Payment.ledgerIndex))
+                                            .where(Payment.status == 'SUCCESS_FINAL')
+                                            .scalar() or -1)
 
-        # Update payments with final transaction info
+        # One sweep of the account txs since the oldest unconfirmed payment, only validated txs are listed
         # Amounts also must be updated to reflect fee substraction
-        for payment in payments:
+        finalPayments = []
+        failedPayments = []
 
-            tx = self.ledger.getTransaction(payment.TXid)
+        for entry in self.history.iterAccountTransactions(self.config['accounts']['lotto']['address'], min(submissionLedgers)):
 
-            if tx['validated'] == True:
+            tx = entry['tx']
+            payment = pendingPayments.pop(tx['hash'], None)
 
-                payment.status = 'SUCCESS_FINAL'
-                payment.amount = int(tx['Amount']) / 1e6
-                payment.ledgerIndex = tx['ledger_index']
-                date = datetime.datetime.utcfromtimestamp(946684800 + int(tx['date'])).strftime('%Y-%m-%d %H:%M:%S')
-                payment.date = date
-                payment.save()
-                print('Updated payment with id = {} => SUCCESS_FINAL [{}]'.format(payment.id, payment.TXtype))
+            if payment is None:
+                continue
 
-                record = None
+            # Binary records cached before results were decoded have no metadata, their result is asked to the server
+            if 'meta' in entry:
+                result = entry['meta']['TransactionResult']
+            else:
+                validatedTX = self.ledger.getTransaction(tx['hash'])
+                result = validatedTX['meta']['TransactionResult'] if validatedTX and validatedTX.get('validated') else None
 
-                if payment.TXtype == 'PRIZE':
+            if result is None:
+                pendingPayments[tx['hash']] = payment
+                continue
 
-                    record = Prize.select().where(Prize.paymentid == payment.id)[0]
+            if result != 'tesSUCCESS':
+                payment.status = 'ERROR'
+                failedPayments.append(payment)
+                continue
 
-                elif payment.TXtype == 'FEE':
+            payment.status = 'SUCCESS_FINAL'
+            payment.amount = int(tx['Amount']) / 1e6
+            payment.ledgerIndex = tx['ledger_index']
+            payment.date = Ingestion.ledgerDate(tx['date'])
+            finalPayments.append(payment)
 
-                    record = Fee.select().where(Fee.paymentid == payment.id)[0]
+            if not pendingPayments:
+                break
 
-                elif payment.TXtype == 'DONATION':
+        # Records of every payment type are fetched and updated at once
+        # Coalesced payments cover several records, which keep their own amounts
+        with db.atomic():
 
-                    record = Donation.select().where(Donation.paymentid == payment.id)[0]
+            if finalPayments or failedPayments:
+                Payment.bulk_update(finalPayments + failedPayments,
+                                    fields=[Payment.status, Payment.amount, Payment.ledgerIndex, Payment.date],
+                                    batch_size=100)
 
-                elif payment.TXtype == 'DEVOLUTION':
+            for TXtype, model in (('PRIZE', Prize), ('FEE', Fee), ('DONATION', Donation), ('DEVOLUTION', Devolution)):
 
-                    record = Devolution.select().where(Devolution.paymentid == payment.id)[0]
+                payments = {payment.id: payment for payment in finalPayments if payment.TXtype == TXtype}
 
-                record.amount = payment.amount
-                record.save()
+                if not payments:
+                    continue
 
-                # Send notifications
-                if self.config['parameters']['notify'] and payment.TXtype != 'DEVOLUTION':
-                    Notifications.paymentNotify(payment, record, self.config)
+                records = collections.defaultdict(list)
 
-            else:
+                for record in model.select().where(model.paymentid.in_(list(payments))):
+                    records[record.paymentid].append(record)
 
-                print('Error in payment with id = {} [{}]'.format(payment.id, payment.TXtype))
+                updatedRecords = []
+
+                for paymentID, paymentRecords in records.items():
+                    if len(paymentRecords) == 1:
+                        paymentRecords[0].amount = payments[paymentID].amount
+                        updatedRecords.append(paymentRecords[0])
+
+                if updatedRecords:
+                    model.bulk_update(updatedRecords, fields=[model.amount], batch_size=100)
+
+            # Notifications are queued along with the payment updates, the outbox worker sends them
+            if self.config['parameters']['notify']:
+                Notifications.queuePaymentNotifications(finalPayments)
+
+        for payment in failedPayments:
+            print('Payment with id = {} failed => ERROR [{}]'.format(payment.id, payment.TXtype))
+
+        for payment in finalPayments:
+            print('Updated payment with id = {} => SUCCESS_FINAL [{}]'.format(payment.id, payment.TXtype))
+
+        for payment in pendingPayments.values():
+            print('Payment with id = {} not validated yet [{}]'.format(payment.id, payment.TXtype))
+
+        # Expired txs are queued again here too, as payments may be processed by hand
+        if pendingPayments:
+            self.resolveInFlightPayments()
 
-        db.close()
+
+    def selectPrize(self, tx):
+        return prizeForTX(tx, self.config['parameters']['prizes'], self.config['parameters']['reservedTags'])
 
 
     def rebuildDBfromLedger(self):
 
-        db.connect(reuse_if_open=True)
+        # El Gordo prize memos don't describe pools, its databases can't be replayed from the ledger
+        if self.elGordo is not None:
+            raise LottoException('Rebuilding El Gordo databases from the ledger is not supported')
 
-        # Reset tables
-        Prize.delete().execute()
-        Fee.delete().execute()
-        Devolution.delete().execute()
-        Participant.delete().execute()
+        # The database is rebuilt into a shadow copy that replaces the live one once finished
+        # Checkpoints are stored in the shadow database, so an interrupted rebuild resumes where it stopped
+        liveDatabase = self.config['parameters']['database']
+        shadowDatabase = liveDatabase + '.rebuild'
 
-        # Init prize TX ranges
-        prizeTXranges = []
+        db.close()
+        initDatabase(shadowDatabase)
+        db.connect()
+        Migrations.migrate()
+        db.create_tables([Prize, Fee, Donation, Devolution, Participant, Payment, PrizePool, Ticket, LedgerTransaction, Notification, RebuildCheckpoint])
 
-        for tx in self.transactions:
+        checkpoint = RebuildCheckpoint.get_or_none()
 
-            tx = tx['tx']
+        if checkpoint is None:
 
-            # Sent txs only
-            if tx['Account'] == self.config['accounts']['lotto']['address'] and 'Memos' in tx:
+            # Start from the locally cached history
+            if os.path.isfile(liveDatabase):
+                db.execute_sql('ATTACH DATABASE ? AS live', (liveDatabase,))
+                db.execute_sql('INSERT OR IGNORE INTO {0} SELECT * FROM live.{0}'.format(LedgerTransaction._meta.table_name))
+                db.execute_sql('DETACH DATABASE live')
 
-                # Read the first memo and decode it
-                memo = tx['Memos'][0]['Memo']['MemoData']
-                memo = bytearray.fromhex(memo).decode()
+            checkpoint = RebuildCheckpoint.create(stage = 'DOWNLOAD')
 
-                if 'ZERPLOTTO.COM' in memo:
+        else:
+
+            print('Resuming rebuild from tx {} (ledger {}, {} prizes restored)'.format(checkpoint.lastProcessedTX,
+                                                                                   checkpoint.lastProcessedLedger,
+                                                                                   checkpoint.prizeCounter))
+
+        if checkpoint.stage == 'DOWNLOAD':
+
+            # The cache stores every page as it arrives, so an interrupted download resumes from the last cached ledger
+            self.history.update(self.config['accounts']['lotto']['address'])
+
+            checkpoint.stage = 'REPLAY'
+            checkpoint.save()
+
+        self.replayHistory(checkpoint)
+
+        # Swap in the rebuilt database
+        db.drop_tables([RebuildCheckpoint])
+        db.close()
+
+        # A WAL left by other connections to the live database must never be applied to the rebuilt one
+        # Leaving WAL mode needs exclusive access, so the swap fails while any other process uses the database
+        if os.path.isfile(liveDatabase):
+
+            initDatabase(liveDatabase)
+
+            try:
+                db.connect()
+                db.execute_sql('PRAGMA journal_mode = DELETE')
+            except OperationalError as e:
+                raise LottoException('Live database is in use, rebuilt database left in {}: {}'.format(shadowDatabase, e))
+            finally:
+                db.close()
+
+        os.replace(shadowDatabase, liveDatabase)
+        initDatabase(liveDatabase)
+
+
+    def replayHistory(self, checkpoint):
+
+        start = time.monotonic()
+        address = self.config['accounts']['lotto']['address']
+
+        # Received txs of every prize not included yet in a restored prize, as sorted (position, hash, ledgerIndex) lists
+        pendingFrom = {int(prizeValue): position for prizeValue, position in json.loads(checkpoint.pendingFrom).items()}
+        pendingTXs = {prizeValue: [] for prizeValue in self.config['parameters']['prizes']}
+        pendingPositions = {}
+
+        # Received txs before the checkpoint are read again to restore the pending ones, the rest of txs are skipped until the checkpoint
+        fromPosition = min(pendingFrom.values(), default=checkpoint.lastProcessedTX + 1)
+
+        nextIDs = {model: (model.select(fn.MAX(model.id)).scalar() or 0) + 1 for model in [Payment, Prize, Fee, Donation, Devolution]}
+        rows = {model: [] for model in nextIDs}
+        insertedRows = 0
+        processedTXs = 0
+
+        for position, ledgerIndex, event in self.iterReplayEvents(address, fromPosition):
 
-                    status = 'SUCCESS_FINAL'
-                    destination = tx['Destination']
-                    amount = int(tx['Amount']) / 1e6
-                    TXid = tx['hash']
-                    ledgerIndex = tx['ledger_index']
-                    date = datetime.datetime.utcfromtimestamp( 946684800 + int(tx['date']) ).strftime('%Y-%m-%d %H:%M:%S')
+            if event is None:
+                pass
 
-                    memoData = memo.split('::')
+            elif event[0] == 'RECEIVED':
 
-                    # Restore payment
-                    payment = Payment(TXtype = '',
-                                      status = 'SUCCESS_FINAL',
-                                      destination = destination,
-                                      amount = amount,
-                                      TXid = TXid,
-                                      ledgerIndex = ledgerIndex,
-                                      date = date,
-                                      memo = memo)
+                _, TXid, prizeValue = event
 
-                    if '_PRIZE' in memo:
+                if position >= pendingFrom.get(prizeValue, checkpoint.lastProcessedTX + 1):
+                    pendingTXs[prizeValue].append((position, TXid, ledgerIndex))
+                    pendingPositions[TXid] = position
 
-                        payment.TXtype = 'PRIZE'
-                        payment.save()
+            elif position > checkpoint.lastProcessedTX:
 
-                        prizeID = memoData[1].split('=')[1]
-                        firstIncludedTX = memoData[2].split('=')[1]
-                        lastIncludedTX = memoData[3].split('=')[1]
-                        winnerTXid = memoData[4].split('=')[1]
+                _, tx, memo = event
 
-                        lastIncludedLedger = self.ledger.getTransaction(lastIncludedTX)['ledger_index']
+                if self.restorePayment(tx, memo, pendingTXs, pendingPositions, nextIDs, rows):
+                    checkpoint.prizeCounter += 1
 
-                        prize = Prize(destination = destination,
-                                      amount = amount,
-                                      paymentid = payment.id,
-                                      winnerTXid = winnerTXid,
-                                      participantTXids = '',
-                                      lastIncludedLedger = lastIncludedLedger)
-                        prize.save()
+            if position <= checkpoint.lastProcessedTX:
+                continue
 
-                        prizeTag = None
-                        for prizeValue in self.config['parameters']['prizes']:
-                            if round(amount / prizeValue) == 1:
-                                prizeTag = prizeValue
-                                break
+            checkpoint.lastProcessedTX = position
+            checkpoint.lastProcessedLedger = ledgerIndex
+            processedTXs += 1
 
-                        prizeTXranges.append((prize.id, firstIncludedTX, lastIncludedTX, prizeTag))
+            # Rows and checkpoint are committed together
+            if processedTXs % rebuildCheckpointInterval == 0:
+                insertedRows += self.saveCheckpoint(checkpoint, pendingTXs, rows)
 
-                    elif '_FEE' in memo:
+        insertedRows += self.saveCheckpoint(checkpoint, pendingTXs, rows)
 
-                        payment.TXtype = 'FEE'
-                        payment.save()
+        print('Rebuilt {} rows from {} txs in {:.2f} seconds'.format(insertedRows, processedTXs, time.monotonic() - start))
 
-                        prizeID = memoData[1].split('=')[1]
 
-                        fee = Fee(destination = destination,
-                                  amount = amount,
-                                  paymentid = payment.id,
-                                  prizeid = prizeID)
+    def iterReplayEvents(self, address, fromPosition):
 
-                        fee.save()
+        # The cached history is split into partitions of consecutive positions, that is, of consecutive ledgers
+        # Workers decode and classify them in parallel, and their events are merged back in history order
+        lastPosition = LedgerTransaction.select(fn.MAX(LedgerTransaction.id)).scalar() or 0
 
-                    elif '_DONATION' in memo:
+        partitions = [(db.database,
+                       address,
+                       self.config['parameters']['prizes'],
+                       self.config['parameters']['reservedTags'],
+                       partitionStart,
+                       partitionStart + rebuildPartitionSize)
+                      for partitionStart in range(fromPosition, lastPosition + 1, rebuildPartitionSize)]
 
-                        payment.TXtype = 'DONATION'
-                        payment.save()
+        if rebuildWorkers <= 1 or len(partitions) <= 1:
 
-                        prizeID = memoData[1].split('=')[1]
+            for partition in partitions:
+                yield from classifyPartition(*partition)
 
-                        donation = Donation(destination = destination,
-                                            amount = amount,
-                                            paymentid = payment.id,
-                                            prizeid = prizeID)
-                        donation.save()
+            return
 
-                    elif '_DEVOLUTION' in memo:
+        # Workers are spawned, forked ones would inherit the open database connection
+        with concurrent.futures.ProcessPoolExecutor(rebuildWorkers, mp_context=multiprocessing.get_context('spawn')) as executor:
 
-                        payment.TXtype = 'DEVOLUTION'
-                        payment.save()
+            # Partitions are submitted in waves to bound the memory used by pending results
+            for i in range(0, len(partitions), rebuildWorkers * 2):
 
-                        receivedTX = memoData[1].split('=')[1]
+                wave = partitions[i:i + rebuildWorkers * 2]
 
-                        devolution = Devolution(amount = amount,
-                                                destination = destination,
-                                                receivedTXid = tx['hash'],
-                                                paymentid = payment.id)
-                        devolution.save()
+                for events in executor.map(classifyPartition, *zip(*wave)):
+                    yield from events
 
 
-        for ptxr in prizeTXranges:
+    def saveCheckpoint(self, checkpoint, pendingTXs, rows):
 
-            prize = Prize.select().where(Prize.id == ptxr[0])[0]
+        # Prizes without pending txs resume right after the checkpoint
+        checkpoint.pendingFrom = json.dumps({prizeValue: txs[0][0] for prizeValue, txs in pendingTXs.items() if txs})
 
-            fromIndex = self.transactions.index(list(filter(lambda t: t['tx']['hash'] == ptxr[1], self.transactions))[0])
-            toIndex =   self.transactions.index(list(filter(lambda t: t['tx']['hash'] == ptxr[2], self.transactions))[0])
+        with db.atomic():
+            insertedRows = self.insertRows(rows.items())
+            checkpoint.save()
 
-            participantTXids = []
+        return insertedRows
 
-            for i in range(0, len(self.transactions)):
 
-                if self.transactions[i]['tx']['hash'] == ptxr[1]:
-                    fromIndex = i
+    def restorePayment(self, tx, memo, pendingTXs, pendingPositions, nextIDs, rows):
 
-                elif self.transactions[i]['tx']['hash'] == ptxr[2]:
-                    toIndex = i
+        # Restores the payment of a sent tx and its record, returns True for prizes
+        memoData = memo.split('::')
+        amount = int(tx['Amount']) / 1e6
+        paymentID = self.allocateID(nextIDs, Payment)
 
-                if (fromIndex is not None) and (toIndex is not None):
+        payment = {'id': paymentID,
+                   'TXtype': '',
+                   'status': 'SUCCESS_FINAL',
+                   'destination': tx['Destination'],
+                   'destinationTag': tx.get('DestinationTag'),
+                   'amount': amount,
+                   'TXid': tx['hash'],
+                   'ledgerIndex': tx['ledger_index'],
+                   'date': Ingestion.ledgerDate(tx['date']),
+                   'memo': memo}
 
-                    for j in range(fromIndex, toIndex + 1):
+        rows[Payment].append(payment)
 
-                        if self.transactions[j]['tx']['Destination'] == self.config['accounts']['lotto']['address']:
+        if '_PRIZE' in memo:
 
-                            if ('DestinationTag' in self.transactions[j]['tx'] 
-                            and self.transactions[j]['tx']['DestinationTag'] == ptxr[3]) or \
-                            ('DestinationTag' not in self.transactions[j]['tx'] 
-                            and ptxr[3] == self.config['parameters']['prizes'][-1]):
+            payment['TXtype'] = 'PRIZE'
 
-                                participantTXids.append(self.transactions[j]['tx']['hash'])
+            firstIncludedTX = memoData[2].split('=')[1]
+            lastIncludedTX = memoData[3].split('=')[1]
+            winnerTXid = memoData[4].split('=')[1]
 
-                    prize.participantTXids = str(participantTXids)[1:-1].replace('\'','').replace(' ','')
-                    prize.save()
+            # Prizes drawn before seeds were recorded have no seed
+            drawSeed = memoData[5].split('=')[1] if len(memoData) > 5 else None
 
+            prizeTag = None
+            for prizeValue in self.config['parameters']['prizes']:
+                if round(amount / prizeValue) == 1:
+                    prizeTag = prizeValue
                     break
 
-        db.close()
+            # Participants are the pending received txs of the same prize between the first and the last included ones
+            participants = []
+            lastIncludedLedger = None
 
+            if prizeTag is not None and firstIncludedTX in pendingPositions and lastIncludedTX in pendingPositions:
 
-    def getParticipantTXsByPrizeID(self, prizeID=-1):
+                prizeTXs = pendingTXs[prizeTag]
+                fromIndex = bisect.bisect_left(prizeTXs, (pendingPositions[firstIncludedTX],))
+                toIndex = bisect.bisect_left(prizeTXs, (pendingPositions[lastIncludedTX] + 1,))
 
-        if prizeID == -1:
+                participants = prizeTXs[fromIndex:toIndex]
 
-            prizes = Prize.select().order_by(Prize.id)
+                if participants:
+                    lastIncludedLedger = participants[-1][2]
+
+                # Consumed and skipped txs are not pending anymore
+                for _, TXid, _ in prizeTXs[:toIndex]:
+                    del pendingPositions[TXid]
+
+                del prizeTXs[:toIndex]
+
+            if lastIncludedLedger is None:
+                lastIncludedLedger = self.history.getTransactions([lastIncludedTX])[lastIncludedTX]['ledger_index']
+
+            rows[Prize].append({'id': self.allocateID(nextIDs, Prize),
+                                'destination': tx['Destination'],
+                                'amount': amount,
+                                'paymentid': paymentID,
+                                'winnerTXid': winnerTXid,
+                                'participantTXids': packTXids(TXid for _, TXid, _ in participants),
+                                'lastIncludedLedger': lastIncludedLedger,
+                                'drawSeed': drawSeed})
 
-            if prizes.exists():
+            return True
 
-                return prizes[-1].participantTXids.replace(' ','').split(',')
+        elif '_FEE' in memo or '_DONATION' in memo or '_DEVOLUTION' in memo:
 
+            if '_DEVOLUTION' in memo:
+                model, field, payment['TXtype'] = Devolution, 'receivedTXid', 'DEVOLUTION'
+            elif '_FEE' in memo:
+                model, field, payment['TXtype'] = Fee, 'prizeid', 'FEE'
             else:
+                model, field, payment['TXtype'] = Donation, 'prizeid', 'DONATION'
 
-                return None
+            # Coalesced payments list every record they cover along with its amount
+            references = memoData[1].split('=')[1].split(',')
+            amounts = [float(value) for value in memoData[2].split('=')[1].split(',')] if len(memoData) > 2 else [amount]
 
+            for reference, recordAmount in zip(references, amounts):
+                rows[model].append({'id': self.allocateID(nextIDs, model),
+                                    'destination': tx['Destination'],
+                                    'amount': recordAmount,
+                                    'paymentid': paymentID,
+                                    field: reference})
+
+        return False
+
+
+    def getParticipantTXsByPrizeID(self, prizeID=-1):
+
+        if prizeID == -1:
+            prize = Prize.select().order_by(Prize.id.desc()).first()
         else:
+            prize = Prize.get_or_none(Prize.id == prizeID)
 
-            prize = Prize.select(Prize.participantTXids).where(Prize.id == prizeID)
+        return prize.getParticipantTXids() if prize else None
 
-            if prize.exists():
-                return prize[0].participantTXids.replace(' ','').split(',')
-            else:
-                return None
+
+    def replayDraw(self, prizeID):
+
+        # Draws a settled prize again from its recorded seed, returns the winner TXid
+        # Participation amounts are read from the transaction history and capped as when they were received
+        prize = Prize.get_or_none(Prize.id == prizeID)
+
+        if prize is None or prize.drawSeed is None:
+            raise LottoException('Prize {} has no recorded draw seed'.format(prizeID))
+
+        participantTXs = prize.getParticipantTXids()
+        txs = self.history.getTransactions(participantTXs)
+
+        amounts = []
+
+        for TXid in participantTXs:
+
+            tx = txs.get(TXid)
+
+            if tx is None:
+                raise LottoException('Participant tx {} of prize {} not found'.format(TXid, prizeID))
+
+            maxParticipation = self.config['parameters']['maxParticipationRatio'] * self.selectPrize(tx)
+            amounts.append(min(int(tx['Amount']) / 1e6, maxParticipation))
+
+        return participantTXs[Draw.replayDraw(amounts, Draw.seedFromHex(prize.drawSeed))]
+
+
+    def settleElGordo(self, winningNumber):
+
+        print('Settling El Gordo with winning number {}...'.format(winningNumber))
+
+        try:
+            winners = self.elGordo.settle(winningNumber)
+        except ElGordo.ElGordoException as e:
+            raise LottoException('Error while settling El Gordo: {}'.format(e))
+
+        print('Jackpot split among {} tickets'.format(winners))
+
+        self.backup()
 
 
     def update(self):
         print("Updating...")
         self.processReceivedTransactions()
-        return self.processPrizes()
+
+        lastPrize = Prize.select(fn.MAX(Prize.id)).scalar()
+        pendingPayments = self.processPrizes()
+
+        # Back up every settlement
+        if Prize.select(fn.MAX(Prize.id)).scalar() != lastPrize:
+            self.backup()
+
+        return pendingPayments
+
+
+    def processNewTransactions(self):
+
+        # Update and process payments
+        if self.update():
+
+            if self.config['parameters']['processPayments']:
+
+                self.processPayments()
+
+            else:
+
+                TelegramNotifier.sendMessage('There are pending payments. Check them with /listPendingPayments '
+                                             'and send them with: python Lotto.py --process-payments', self.config)
+
+
+    def runDaemon(self):
+
+        address = self.config['accounts']['lotto']['address']
+        reconnect = False
+
+        print('Listening to {} transactions...'.format(address))
+
+        if self.config['parameters']['notify']:
+            self.ledger.loop.create_task(self.notifier.run())
+
+        while True:
+
+            try:
+
+                if reconnect:
+                    self.ledger.reconnect()
+                    reconnect = False
+
+                self.ledger.subscribe([address])
+
+                # Catch up with the txs validated while not listening
+                self.updateAccountInfo()
+                self.getLastTransactions()
+                self.processNewTransactions()
+                self.checkPayments()
+
+                while True:
+
+                    message = self.ledger.getStreamMessage()
+
+                    if message.get('type') != 'transaction' or not message.get('validated'):
+                        continue
+
+                    tx = message['transaction']
+
+                    if tx['TransactionType'] != 'Payment':
+                        continue
+
+                    # New ticket: the cache fetches the delta, so no tx can be missed
+                    if tx['Destination'] == address:
+
+                        print('Received tx {} on ledger {}'.format(tx['hash'], message['ledger_index']))
+                        self.waitForLedger(message['ledger_index'])
+                        self.updateAccountInfo()
+                        self.getLastTransactions()
+                        self.processNewTransactions()
+
+                    # One of our payments has been validated
+                    elif tx['Account'] == address:
+
+                        self.waitForLedger(message['ledger_index'])
+                        self.checkPayments()
+
+            except (ConnectionError, OSError, websockets.exceptions.ConnectionClosed) as e:
+
+                print('Connection lost ({}), reconnecting in {} seconds...'.format(e, reconnectDelay))
+                # Background reconnections and the notification worker only run while the ledger's loop does
+                self.ledger.wait(reconnectDelay)
+                reconnect = True
+
+
+    def waitForLedger(self, ledgerIndex):
+
+        # History requests may be answered by a server of the pool behind the streaming one
+        # The delta is fetched again until it includes the streamed ledger, which holds a tx of the account
+        address = self.config['accounts']['lotto']['address']
+
+        for attempt in range(catchUpAttempts):
+
+            self.history.update(address)
+
+            if (self.history.getLastCachedLedger(address) or -1) >= ledgerIndex:
+                return True
+
+            self.ledger.wait(catchUpInterval)
+
+        print('Ledger {} not available yet, it will be processed with the next event'.format(ledgerIndex))
+
+        return False
 
 
     def processPayments(self):
 
         print('Processing payments...')
 
-        result = subprocess.run(['which', 'node'],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+        try:
+            PaymentSubmitter.PaymentSubmitter(self.ledger, self.config).submitPendingPayments()
+        except PaymentSubmitter.PaymentSubmitterException as e:
+            raise LottoException('Error while processing payments: {}'.format(e))
 
-        nodeCmd = result.stdout.decode("utf-8").replace('\n', '')
 
-        if testing:
+    def resolveInFlightPayments(self):
 
-            result = subprocess.run([nodeCmd, './processPayments.js',],
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
+        try:
+            PaymentSubmitter.PaymentSubmitter(self.ledger, self.config).resolveInFlightPayments()
+        except PaymentSubmitter.PaymentSubmitterException as e:
+            raise LottoException('Error while checking submitted payments: {}'.format(e))
 
-        else:
 
-            result = subprocess.run([nodeCmd, './processPayments.js', '--testing=False'],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
+    def sendNotifications(self):
 
-        print(result.stdout.decode("utf-8").replace('\\n', '\n'))
-        print(result.stderr.decode("utf-8").replace('\\n', '\n'))
-
-        if result.returncode != 0:
-            raise LottoException('Error while processing payments')
+        if self.config['parameters']['notify']:
+            self.notifier.sendPending(notificationTimeout)
 
 
     def backup(self):
-        filename = 'XRPLotto-backup-{}.db'.format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        shutil.copyfile(db.database, filename)
+
+        # Taken in background, the engine goes on while the database is copied
+        self.backups.start()
 
 
 if __name__ == "__main__":
@@ -617,9 +1152,12 @@ if __name__ == "__main__":
 
     try:
 
-        # Load configuration
+        # Load configuration, games other than the default one run with their own configuration file
         configFilePath = 'configTest.json' if testing else 'config.json'
 
+        if '--config' in sys.argv:
+            configFilePath = sys.argv[sys.argv.index('--config') + 1]
+
         with open(configFilePath, 'r') as configFile:
 
             config = json.load(configFile) # TODO: validate json scheme
@@ -638,19 +1176,37 @@ if __name__ == "__main__":
             # Instantiate Lotto
             lotto = Lotto(config)
 
-            # Update and process payments
-            if lotto.update():
+            # Keep processing txs as they are validated
+            if '--daemon' in sys.argv:
 
-                if config['parameters']['processPayments']:
+                lotto.runDaemon()
 
+            else:
+
+                # El Gordo is settled with its winning number, after including every ticket received
+                if '--elgordo' in sys.argv:
+
+                    if lotto.elGordo is None:
+                        raise LottoException('El Gordo is not the configured game')
+
+                    lotto.processReceivedTransactions()
+                    lotto.settleElGordo(int(sys.argv[sys.argv.index('--elgordo') + 1]))
+
+                # Update and process payments
+                lotto.processNewTransactions()
+
+                # Payments are sent by hand when their automatic processing is disabled
+                if '--process-payments' in sys.argv:
                     lotto.processPayments()
 
-                else:
-                    
-                    TelegramNotifier.sendMessage('There are pending payments.', config)
+                # Check payments    
+                lotto.checkPayments()
+
+                # Send the queued notifications
+                lotto.sendNotifications()
 
-            # Check payments    
-            lotto.checkPayments()
+                # A backup started by a settlement finishes before the lock is released
+                lotto.backups.wait()
 
     except Exception as e:
 
@@ -0,0 +1,89 @@
+from peewee import *
+from DBmodels import *
+
+
+# Schema changes of existing databases, in order
+# The schema version of a database is kept in SQLite's user_version, a migration is applied once and never edited afterwards
+# New databases are created with the current models by db.create_tables, so they start at the last version
+
+
+def addLookupIndexes():
+
+    # Devolutions and participants are unique per received tx
+    for table, column, unique in [('participant', 'TXid', True),
+                                  ('participant', 'prize', False),
+                                  ('payment', 'status', False),
+                                  ('payment', 'TXid', False),
+                                  ('devolution', 'receivedTXid', True),
+                                  ('prize', 'paymentid', False),
+                                  ('fee', 'paymentid', False),
+                                  ('donation', 'paymentid', False),
+                                  ('devolution', 'paymentid', False)]:
+
+        if table in db.get_tables():
+            db.execute_sql('CREATE {}INDEX IF NOT EXISTS "{}_{}" ON "{}" ("{}")'.format('UNIQUE ' if unique else '',
+                                                                                     table, column, table, column))
+
+
+def packParticipantTXids():
+
+    # Comma separated hex hashes are replaced by packed ones, in place
+    if 'prize' not in db.get_tables():
+        return
+
+    prizes = db.execute_sql('SELECT id, participantTXids FROM prize WHERE typeof(participantTXids) = \'text\'').fetchall()
+
+    for batch in chunked(prizes, 100):
+        db.cursor().executemany('UPDATE prize SET participantTXids = ? WHERE id = ?',
+                                [(packTXids(TXid for TXid in TXids.replace(' ', '').split(',') if TXid), prizeID)
+                                 for prizeID, TXids in batch])
+
+
+def addPrizeDrawSeed():
+
+    if 'prize' in db.get_tables() and 'drawSeed' not in [column.name for column in db.get_columns('prize')]:
+        db.execute_sql('ALTER TABLE prize ADD COLUMN "drawSeed" TEXT')
+
+
+def addPaymentLastLedgerSequence():
+
+    if 'payment' in db.get_tables() and 'lastLedgerSequence' not in [column.name for column in db.get_columns('payment')]:
+        db.execute_sql('ALTER TABLE payment ADD COLUMN "lastLedgerSequence" INTEGER')
+
+
+migrations = [addLookupIndexes, packParticipantTXids, addPrizeDrawSeed, addPaymentLastLedgerSequence]
+
+
+class MigrationException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def getSchemaVersion():
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+
+def setSchemaVersion(version):
+    db.execute_sql('PRAGMA user_version = {}'.format(int(version)))
+
+
+def migrate():
+
+    # Must run before db.create_tables, which would take an empty database for an existing one
+    version = getSchemaVersion()
+
+    if version > len(migrations):
+        raise MigrationException('Database schema version {} is newer than this code ({})'.format(version, len(migrations)))
+
+    if not db.get_tables():
+        setSchemaVersion(len(migrations))
+        return
+
+    # Every migration is committed along with its version, so an interrupted upgrade resumes with the failed one
+    for number, migration in enumerate(migrations[version:], version + 1):
+
+        print('Migrating database schema to version {} ({})'.format(number, migration.__name__))
+
+        with db.atomic():
+            migration()
+            setSchemaVersion(number)
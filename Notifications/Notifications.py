@@ -1,36 +1,61 @@
 from Notifications import TelegramNotifier, TwitterNotifier, Pastebin
+from DBmodels import *
+import asyncio
+import functools
+import requests
+import random
+import json
+import time
 
-def paymentNotify(payment, record, config):
 
-    TXlink = TwitterNotifier.ShortenURL().Shorten(config['links']['bithomp'] + payment.TXid)
+# Providers notified for each payment type
+paymentChannels = {'PRIZE': ['twitter', 'telegram'],
+                   'FEE': ['telegram'],
+                   'DONATION': ['twitter', 'telegram']}
 
-    # Prepare messages
-    message = None
+# Retry backoff bounds in seconds and attempts before giving up a notification
+minBackoff = 30
+maxBackoff = 3600
+maxAttempts = 10
 
-    if payment.TXtype == 'PRIZE':
+# Seconds between outbox checks of the worker
+pollInterval = 10
+
+
+class NotificationException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+def queuePaymentNotifications(payments):
 
-        participantTXs = record.participantTXids.replace(' ','').split(',')
+    # Notifications are stored in the outbox, the worker sends them later
+    rows = [{'paymentid': payment.id,
+             'channels': json.dumps(paymentChannels[payment.TXtype]),
+             'status': 'PENDING'} for payment in payments if payment.TXtype in paymentChannels]
 
-        pastebinlink = Pastebin.createPaste('ZerpLotto participant TXs for prize {}'.format(record.id),
-                                            ('\n').join(participantTXs),
-                                            config)
+    if rows:
+        Notification.insert_many(rows).execute()
 
-        message = 'A new ZerpLotto prize has been sent. Congratulations to the winner!\n' \
-                  'Amount: {} XRP\n' \
-                  'Winner: {}\n' \
-                  'Prize TX: {}\n' \
-                  'Participant TXs: {}' \
-                  .format(payment.amount, payment.destination, TXlink, pastebinlink)
 
-        TwitterNotifier.postUpdate(message, config)
+def paymentMessage(payment, links, config):
+
+    if payment.TXtype == 'PRIZE':
+
+        return 'A new ZerpLotto prize has been sent. Congratulations to the winner!\n' \
+               'Amount: {} XRP\n' \
+               'Winner: {}\n' \
+               'Prize TX: {}\n' \
+               'Participant TXs: {}' \
+               .format(payment.amount, payment.destination, links['TX'], links['participants'])
 
     elif payment.TXtype == 'FEE':
 
-        message = 'A new ZerpLotto fee has been sent.\n' \
-                  'Amount: {} XRP\n' \
-                  'Destination: {}\n' \
-                  'Fee TX: {}\n' \
-                  .format(payment.amount, payment.destination, TXlink)
+        return 'A new ZerpLotto fee has been sent.\n' \
+               'Amount: {} XRP\n' \
+               'Destination: {}\n' \
+               'Fee TX: {}\n' \
+               .format(payment.amount, payment.destination, links['TX'])
 
     elif payment.TXtype == 'DONATION':
 
@@ -40,13 +65,200 @@ def paymentNotify(payment, record, config):
                 charityName = i
                 break
 
-        message = 'A new ZerpLotto donation has been sent.\n' \
-                  'Amount: {} XRP\n' \
-                  'Destination: {}\n' \
-                  'Prize TX: {}' \
-                  .format(payment.amount, charityName, TXlink)
+        return 'A new ZerpLotto donation has been sent.\n' \
+               'Amount: {} XRP\n' \
+               'Destination: {}\n' \
+               'Prize TX: {}' \
+               .format(payment.amount, charityName, links['TX'])
+
+
+class NotificationWorker:
+    # Drains the notification outbox on the given event loop
+    # Providers are blocking clients, so their calls run in the default executor, created once and reused
+
+    def __init__(self, config, loop):
+
+        self.config = config
+        self.loop = loop
+        self.session = requests.Session()
+        self.shortener = TwitterNotifier.ShortenURL(session=self.session)
+        self.twitterApi = None
+        self.telegramBot = None
+        self.inFlight = set()
+
+
+    def call(self, function, *args):
+        return self.loop.run_in_executor(None, functools.partial(function, *args))
+
+
+    def getTwitterApi(self):
+
+        if self.twitterApi is None:
+            self.twitterApi = TwitterNotifier.createApi(self.config)
+
+        return self.twitterApi
+
+
+    def getTelegramBot(self):
+
+        if self.telegramBot is None:
+            self.telegramBot = TelegramNotifier.createBot(self.config)
+
+        return self.telegramBot
+
+
+    def createPaste(self, name, message):
+
+        link = Pastebin.createPaste(name, message, self.config, self.session)
+
+        if link is None:
+            raise NotificationException('Pastebin paste could not be created')
+
+        return link
+
+
+    async def createLinks(self, payment, links):
+
+        # Links already created in previous attempts are kept, so retries don't create them again
+        tasks = {}
+
+        if 'TX' not in links:
+            tasks['TX'] = self.call(self.shortener.Shorten, self.config['links']['bithomp'] + payment.TXid)
+
+        if payment.TXtype == 'PRIZE' and 'participants' not in links:
+            prize = Prize.get(Prize.paymentid == payment.id)
+            tasks['participants'] = self.call(self.createPaste,
+                                              'ZerpLotto participant TXs for prize {}'.format(prize.id),
+                                              '\n'.join(prize.getParticipantTXids()))
+
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        errors = []
+
+        for name, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                links[name] = result
+
+        if errors:
+            raise NotificationException('Links could not be created: {}'.format(', '.join(repr(e) for e in errors)))
+
+
+    def sendToChannel(self, channel, message):
+
+        if channel == 'twitter':
+            TwitterNotifier.postUpdate(message, self.config, self.getTwitterApi())
+        elif channel == 'telegram':
+            TelegramNotifier.sendMessage(message, self.config, self.getTelegramBot())
+
+
+    def post(self, notification, channels, channel, message):
+
+        # Posts can't be taken back once handed to the executor, so they are shielded from cancellations of the drain
+        # and their result is saved as soon as the provider answers
+        future = self.call(self.sendToChannel, channel, message)
+        self.inFlight.add(future)
+        future.add_done_callback(functools.partial(self.posted, notification, channels, channel))
+
+        return asyncio.shield(future)
+
+
+    def posted(self, notification, channels, channel, future):
+
+        self.inFlight.discard(future)
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        channels.remove(channel)
+        notification.channels = json.dumps(channels)
+
+        if not channels:
+            notification.status = 'SENT'
+
+        notification.save()
+
+
+    async def deliver(self, notification):
+
+        channels = json.loads(notification.channels)
+        links = json.loads(notification.links)
+        payment = Payment.get_by_id(notification.paymentid)
+
+        try:
+
+            await self.createLinks(payment, links)
+
+            notification.links = json.dumps(links)
+            notification.save()
+
+            # Every provider is called at once, only the failed ones are retried
+            message = paymentMessage(payment, links, self.config)
+            results = await asyncio.gather(*[self.post(notification, channels, channel, message) for channel in list(channels)],
+                                           return_exceptions=True)
+
+            errors = [result for result in results if isinstance(result, Exception)]
+
+            if errors:
+                raise NotificationException(', '.join(repr(e) for e in errors))
+
+        except NotificationException as e:
+
+            notification.attempts += 1
+
+            if notification.attempts >= maxAttempts:
+                notification.status = 'FAILED'
+
+            # Jittered exponential backoff
+            backoff = min(maxBackoff, minBackoff * 2 ** (notification.attempts - 1))
+            notification.nextAttempt = time.time() + random.uniform(backoff / 2, backoff)
+
+            print('Notification of payment with id = {} failed (attempt {}): {}'.format(payment.id, notification.attempts, e))
+
+        notification.channels = json.dumps(channels)
+        notification.links = json.dumps(links)
+        notification.save()
+
+
+    async def drain(self):
+
+        # Sends the due notifications, returns the pending ones left
+        db.connect(reuse_if_open=True)
+
+        notifications = list(Notification.select().where( (Notification.status == 'PENDING') &
+                                                          (Notification.nextAttempt <= time.time()) )
+                                                  .order_by(Notification.id))
+
+        await asyncio.gather(*[self.deliver(notification) for notification in notifications])
+
+        return Notification.select().where(Notification.status == 'PENDING').count()
+
+
+    async def run(self):
+
+        # Background task of the daemon
+        while True:
+
+            try:
+                await self.drain()
+            except Exception as e:
+                print('Notification worker error: {}'.format(repr(e)))
+
+            await asyncio.sleep(pollInterval)
+
+
+    def sendPending(self, timeout):
+
+        # One-shot runs send the due notifications once, failed ones wait for the next run
+        try:
+            pending = self.loop.run_until_complete(asyncio.wait_for(self.drain(), timeout))
+        except asyncio.TimeoutError:
 
-        TwitterNotifier.postUpdate(message, config)
+            # Posts already sent to the providers are awaited, so their results are saved and never posted again
+            if self.inFlight:
+                self.loop.run_until_complete(asyncio.gather(*self.inFlight, return_exceptions=True))
 
+            pending = Notification.select().where(Notification.status == 'PENDING').count()
 
-    TelegramNotifier.sendMessage(message, config)
+        if pending:
+            print('{} notifications pending'.format(pending))
@@ -1,6 +1,6 @@
 import requests
 
-def createPaste(name, message, config):
+def createPaste(name, message, config, session=requests):
 
     data = {"api_dev_key": config['credentials']['pastebin']['api_dev_key'], 
             "api_user_key": config['credentials']['pastebin']['api_user_key'],
@@ -10,7 +10,7 @@ def createPaste(name, message, config):
             "api_paste_private": "0",
             "api_paste_expire_date": "N"}
 
-    req = requests.post("https://pastebin.com/api/api_post.php", data=data)
+    req = session.post("https://pastebin.com/api/api_post.php", data=data)
 
     if req.status_code == 200 and req.reason == 'OK':
         return req.text
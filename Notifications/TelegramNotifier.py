@@ -1,7 +1,10 @@
 import telegram
 
-def sendMessage(message, config):
-    """Sends a simple message."""
-    bot = telegram.Bot(token=config['credentials']['telegram']['key'])
+def createBot(config):
+    return telegram.Bot(token=config['credentials']['telegram']['key'])
+
+def sendMessage(message, config, bot=None):
+    """Sends a simple message, through the given bot if any."""
+    bot = bot or createBot(config)
     bot.send_message(chat_id=config['credentials']['telegram']['chat_id'], text=message)
 
@@ -4,12 +4,17 @@ try:
 except:
     from urllib2 import urlopen
 
-def postUpdate(message, config):
+def createApi(config):
 
-    api = twitter.Api(consumer_key        = config['credentials']['twitter']['consumer_key'],
-                      consumer_secret     = config['credentials']['twitter']['consumer_secret'],
-                      access_token_key    = config['credentials']['twitter']['access_token_key'],
-                      access_token_secret = config['credentials']['twitter']['access_token_secret'])
+    return twitter.Api(consumer_key        = config['credentials']['twitter']['consumer_key'],
+                       consumer_secret     = config['credentials']['twitter']['consumer_secret'],
+                       access_token_key    = config['credentials']['twitter']['access_token_key'],
+                       access_token_secret = config['credentials']['twitter']['access_token_secret'])
+
+
+def postUpdate(message, config, api=None):
+
+    api = api or createApi(config)
 
     #print(api.VerifyCredentials())
 
@@ -23,16 +28,19 @@ class ShortenURL(object):
 
     def __init__(self,
                  userid=None,
-                 password=None):
+                 password=None,
+                 session=None):
         """Instantiate a new ShortenURL object. TinyURL, which is used for this
         example, does not require a userid or password, so you can try this
         out without specifying either.
         Args:
             userid:   userid for any required authorization call [optional]
             password: password for any required authorization call [optional]
+            session:  requests session reused across calls [optional]
         """
         self.userid = userid
         self.password = password
+        self.session = session
 
     def Shorten(self,
                 long_url):
@@ -45,6 +53,12 @@ class ShortenURL(object):
             long_url is required and no checks are made to ensure completeness
         """
 
+        if self.session is not None:
+            response = self.session.get("http://tinyurl.com/api-create.php",
+                                        params={'url': long_url})
+            response.raise_for_status()
+            return response.text
+
         result = None
         f = urlopen("http://tinyurl.com/api-create.php?url={0}".format(
             long_url))
@@ -0,0 +1,339 @@
+from peewee import *
+from DBmodels import *
+from xrpl.core import binarycodec, keypairs
+import TransactionRecord
+import collections
+import time
+
+
+# Ledgers a submitted payment stays valid, as ripple-lib's maxLedgerVersionOffset
+maxLedgerVersionOffset = 5
+
+# Submission bursts per run, seconds between checks of the submitted txs and max seconds waiting for them
+maxAttempts = 3
+pollInterval = 2
+maxWait = 120
+
+# Network fee cushion over the open ledger fee and max fee in drops
+feeCushion = 1.2
+maxFee = 2000000
+
+# Fully canonical signatures flag
+tfFullyCanonicalSig = 0x80000000
+
+# Submission result classes of txs that can never be applied, any other result may still be validated
+rejectedResults = ('tef', 'tem')
+
+# Records of each payment type that can be merged into one tx, and the field identifying them in the memo
+coalescedRecords = {'FEE': (Fee, 'prizeid', 'Prize_id'),
+                    'DONATION': (Donation, 'prizeid', 'Prize_id'),
+                    'DEVOLUTION': (Devolution, 'receivedTXid', 'Received_TX')}
+
+# Memos are limited to 1KB per tx, coalesced groups are split to stay below it
+maxMemoLength = 900
+
+
+class PaymentSubmitterException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+
+class PaymentSubmitter:
+    # Signs the queued payments locally and submits them through the lotto's Ledger connection
+
+    def __init__(self, ledger, config):
+
+        self.ledger = ledger
+        self.config = config
+        self.address = config['accounts']['lotto']['address']
+        self.publicKey, self.privateKey = keypairs.derive_keypair(config['accounts']['lotto']['secret'])
+
+        if keypairs.derive_classic_address(self.publicKey) != self.address:
+            raise PaymentSubmitterException('Lotto secret does not belong to {}'.format(self.address))
+
+
+    def getFee(self):
+
+        result = self.ledger.get({"command": "fee"})
+
+        if result is None:
+            raise PaymentSubmitterException('Error retrieving network fee')
+
+        fee = max(int(result['drops']['base_fee']), int(result['drops']['open_ledger_fee']))
+
+        return min(maxFee, int(fee * feeCushion))
+
+
+    def getSequences(self):
+
+        # Account sequence and current ledger are requested once for the whole batch
+        accountInfo, ledgerCurrent = self.ledger.getMany([{"command": "account_info", "account": self.address},
+                                                          {"command": "ledger_current"}])
+
+        if accountInfo is None or ledgerCurrent is None:
+            raise PaymentSubmitterException('Error retrieving account sequence')
+
+        return accountInfo['account_data']['Sequence'], ledgerCurrent['ledger_current_index']
+
+
+    def sign(self, payment, fee, sequence, lastLedgerSequence):
+
+        # The network fee is paid out of the payment amount
+        tx = {
+              "TransactionType": "Payment",
+              "Account": self.address,
+              "Destination": payment.destination,
+              "Amount": str(round(payment.amount * 1e6) - fee),
+              "Fee": str(fee),
+              "Flags": tfFullyCanonicalSig,
+              "Sequence": sequence,
+              "LastLedgerSequence": lastLedgerSequence,
+              "SigningPubKey": self.publicKey,
+              "Memos": [{"Memo": {"MemoData": payment.memo.encode().hex().upper(),
+                                  "MemoFormat": "text/plain".encode().hex().upper()}}]
+        }
+
+        if payment.destinationTag is not None:
+            tx['DestinationTag'] = payment.destinationTag
+
+        tx['TxnSignature'] = keypairs.sign(binarycodec.encode_for_signing(tx), self.privateKey)
+        blob = binarycodec.encode(tx)
+
+        return blob, TransactionRecord.transactionHash(bytes.fromhex(blob))
+
+
+    def submit(self, payments):
+
+        fee = self.getFee()
+        sequence, currentLedger = self.getSequences()
+        lastLedgerSequence = currentLedger + maxLedgerVersionOffset
+
+        # Consecutive sequences are assigned locally, so every payment is signed before submitting any of them
+        signedPayments = []
+
+        for payment in payments:
+
+            blob, TXid = self.sign(payment, fee, sequence, lastLedgerSequence)
+            signedPayments.append((payment, blob))
+            sequence += 1
+
+            # Until validated, ledgerIndex keeps the ledger the tx was submitted at, where finality checks start looking for it
+            payment.TXid = TXid
+            payment.status = 'SUCCESS_NOT_FINAL'
+            payment.ledgerIndex = currentLedger
+            payment.lastLedgerSequence = lastLedgerSequence
+
+            print('Sending {} XRP to {}'.format(payment.amount, payment.destination))
+
+        # Hashes are stored before sending anything, a burst interrupted halfway leaves every tx in flight, never unknown
+        self.savePayments(payments)
+
+        # Submit the whole burst pipelined over the same connection
+        results = self.ledger.getMany([{"command": "submit", "tx_blob": blob} for _, blob in signedPayments])
+
+        submittedPayments = {}
+        rejectedPayments = []
+
+        for (payment, _), result in zip(signedPayments, results):
+
+            # Only tef and tem results guarantee the tx will never be applied, so only those can be signed again
+            # Anything else, terPRE_SEQ of out of order submits or no answer included, may still be validated
+            if result is not None and result['engine_result'].startswith(rejectedResults):
+                print('Payment with id = {} rejected with {}'.format(payment.id, result['engine_result']))
+                payment.TXid = None
+                payment.status = 'ERROR'
+                payment.ledgerIndex = None
+                payment.lastLedgerSequence = None
+                rejectedPayments.append(payment)
+            else:
+                submittedPayments[payment.TXid] = payment
+
+        self.savePayments(rejectedPayments)
+
+        return submittedPayments
+
+
+    def checkSubmitted(self, unresolved):
+
+        # One lookup of the in flight payments, given by TXid, resolved ones are removed from unresolved
+        # Returns the failed payments and the expired ones, which are queued again
+        validatedLedger, responses = self.ledger.lookupTransactions([(TXid, payment.ledgerIndex, payment.lastLedgerSequence)
+                                                                     for TXid, payment in unresolved.items()])
+        failedPayments = []
+        expiredPayments = []
+
+        for TXid, response in responses.items():
+
+            payment = unresolved[TXid]
+            result = self.ledger.result(response)
+
+            if result is not None and result.get('validated'):
+
+                del unresolved[TXid]
+
+                # Failed txs consume their sequence and fee, but they must not be retried automatically
+                if result['meta']['TransactionResult'] != 'tesSUCCESS':
+                    print('Payment with id = {} failed with {}'.format(payment.id, result['meta']['TransactionResult']))
+                    payment.status = 'ERROR'
+                    failedPayments.append(payment)
+
+            # Expired only when the server that validated a ledger past its LastLedgerSequence searched the whole range
+            elif response.get('error') == 'txnNotFound' and self.ledger.searchedAll(response) and \
+                 validatedLedger is not None and validatedLedger > payment.lastLedgerSequence:
+
+                del unresolved[TXid]
+
+                print('Payment with id = {} expired, queued again'.format(payment.id))
+                payment.TXid = None
+                payment.status = 'PENDING'
+                payment.ledgerIndex = None
+                payment.lastLedgerSequence = None
+                expiredPayments.append(payment)
+
+        return failedPayments, expiredPayments
+
+
+    def waitForOutcome(self, submittedPayments):
+
+        # Tracks the submitted txs until they are validated or proven expired
+        # Returns the expired payments, which can be safely signed again
+        # Payments still unresolved are left in flight, the next run resolves them
+        deadline = time.monotonic() + maxWait
+        unresolved = dict(submittedPayments)
+        failedPayments = []
+        expiredPayments = []
+
+        while unresolved and time.monotonic() < deadline:
+
+            self.ledger.wait(pollInterval)
+
+            failed, expired = self.checkSubmitted(unresolved)
+            failedPayments += failed
+            expiredPayments += expired
+
+        self.savePayments(failedPayments + expiredPayments)
+
+        return expiredPayments
+
+
+    def resolveInFlightPayments(self):
+
+        # Payments left in flight by previous runs, expired ones are queued again before selecting the pending ones
+        inFlight = {payment.TXid: payment
+                    for payment in Payment.select().where( (Payment.status == 'SUCCESS_NOT_FINAL') &
+                                                           (Payment.TXid.is_null(False)) &
+                                                           (Payment.lastLedgerSequence.is_null(False)) )}
+
+        if inFlight:
+            failedPayments, expiredPayments = self.checkSubmitted(inFlight)
+            self.savePayments(failedPayments + expiredPayments)
+
+
+    def savePayments(self, payments):
+
+        if not payments:
+            return
+
+        with db.atomic():
+            Payment.bulk_update(payments,
+                                fields=[Payment.TXid, Payment.status, Payment.ledgerIndex, Payment.lastLedgerSequence],
+                                batch_size=100)
+
+        for payment in payments:
+            print('Updated payment with id = {} => {} [{}]'.format(payment.id, payment.status, payment.TXtype))
+
+
+    def coalescePayments(self):
+
+        # Merges the pending payments of the same type, destination and tag into a single payment
+        # Every record keeps its own amount and is linked to the merged payment, whose memo lists them all
+        payments = Payment.select().where( (Payment.TXid.is_null()) &
+                                           (Payment.TXtype.in_(list(coalescedRecords))) ).order_by(Payment.id)
+
+        groups = collections.defaultdict(list)
+
+        for payment in payments:
+            groups[(payment.TXtype, payment.destination, payment.destinationTag)].append(payment)
+
+        with db.atomic():
+
+            for (TXtype, destination, destinationTag), group in groups.items():
+
+                model, field, memoField = coalescedRecords[TXtype]
+
+                # Payments coalesced before and queued again already cover several records
+                records = collections.defaultdict(list)
+
+                for record in model.select().where(model.paymentid.in_([payment.id for payment in group])).order_by(model.id):
+                    records[record.paymentid].append(record)
+
+                for batch in self.splitByMemoLength(TXtype, memoField, field, group, records):
+
+                    if len(batch) < 2:
+                        continue
+
+                    batchRecords = [record for payment in batch for record in records[payment.id]]
+                    memo = self.coalescedMemo(TXtype, memoField, field, batchRecords)
+
+                    coalescedPayment = Payment.create(TXtype=TXtype,
+                                                      status='PENDING',
+                                                      destination=destination,
+                                                      destinationTag=destinationTag,
+                                                      amount=round(sum(payment.amount for payment in batch), 6),
+                                                      memo=memo)
+
+                    paymentIDs = [payment.id for payment in batch]
+                    model.update(paymentid=coalescedPayment.id).where(model.paymentid.in_(paymentIDs)).execute()
+                    Payment.delete().where(Payment.id.in_(paymentIDs)).execute()
+
+                    print('Coalesced {} {} payments to {} into payment with id = {}'
+                          .format(len(batch), TXtype, destination, coalescedPayment.id))
+
+
+    @staticmethod
+    def coalescedMemo(TXtype, memoField, field, records):
+        return 'ZERPLOTTO.COM_{}::{}={}::Amounts={}'.format(TXtype,
+                                                          memoField,
+                                                          ','.join(str(getattr(record, field)) for record in records),
+                                                          ','.join(str(record.amount) for record in records))
+
+
+    def splitByMemoLength(self, TXtype, memoField, field, payments, records):
+
+        # Payments without record (never expected) are left to be sent on their own
+        batch = []
+
+        for payment in payments:
+
+            if payment.id not in records:
+                yield [payment]
+                continue
+
+            candidate = [record for p in batch + [payment] for record in records[p.id]]
+
+            if batch and len(self.coalescedMemo(TXtype, memoField, field, candidate)) > maxMemoLength:
+                yield batch
+                batch = []
+
+            batch.append(payment)
+
+        if batch:
+            yield batch
+
+
+    def submitPendingPayments(self):
+
+        self.resolveInFlightPayments()
+
+        if self.config['parameters']['coalescePayments']:
+            self.coalescePayments()
+
+        payments = list(Payment.select().where(Payment.TXid.is_null()).order_by(Payment.id))
+
+        # Expired payments are submitted again right away with fresh sequences
+        for attempt in range(maxAttempts):
+
+            if not payments:
+                break
+
+            payments = self.waitForOutcome(self.submit(payments))
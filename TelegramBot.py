@@ -24,8 +24,8 @@ logger = logging.getLogger(__name__)
 # Create ledger
 ledger = Ledger.Ledger(config['parameters']['connection'])
 
-# Create database connection
-db.init(config['parameters']['database'])
+# Read-only database connections, kept open by every handler thread while the lotto writes
+initDatabase(config['parameters']['database'], readOnly=True)
 
 
 def status(bot, update):
@@ -34,15 +34,14 @@ def status(bot, update):
 
         db.connect(reuse_if_open=True)
 
-        participants = Participant.select()
-
         prizestatus = {p: {'participants': 0, 'balance': 0} for p in config['parameters']['prizes']}
 
         totalPlayedBalance = 0
 
-        for p in participants:
-            prizestatus[p.prize]['participants'] += 1
-            prizestatus[p.prize]['balance'] += p.amount
+        # Aggregates maintained by the lotto, no need to read the participants
+        for pool in PrizePool.select().where(PrizePool.prize.in_(list(prizestatus))):
+            prizestatus[pool.prize]['participants'] = pool.participants
+            prizestatus[pool.prize]['balance'] = pool.balance
 
         message = ''
 
@@ -68,10 +67,6 @@ def status(bot, update):
 
         update.message.reply_text('Empty database!')
 
-    finally:
-
-        db.close()
-
 
 def last(bot, update):
 
@@ -139,10 +134,6 @@ def listPendingPayments(bot, update):
 
         update.message.reply_text('Empty database!')
 
-    finally:
-
-        db.close()
-
 
 def lock(bot, update):
     if os.path.isfile(lockFileName):
@@ -0,0 +1,66 @@
+# Measures Lotto.processPrizes against the number of waiting participants
+# Run from the repository root: python Tools/benchmarkPrizes.py
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import Lotto
+from DBmodels import *
+
+
+def benchmark(nparticipants, config):
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        db.init(os.path.join(directory, 'benchmark.db'))
+        db.create_tables([Prize, Fee, Donation, Devolution, Participant, Payment, PrizePool])
+
+        prizeValue = config['parameters']['prizes'][-1]
+
+        rows = [{'address': 'r{}'.format(i % 100),
+                 'amount': 1 + i % 5,
+                 'prize': prizeValue,
+                 'TXid': '{:064X}'.format(i),
+                 'ledgerIndex': i} for i in range(nparticipants)]
+
+        with db.atomic():
+            for batch in chunked(rows, 100):
+                Participant.insert_many(batch).execute()
+
+        Lotto.Lotto.refreshPrizePools()
+
+        # Lotto without ledger connection
+        lotto = Lotto.Lotto.__new__(Lotto.Lotto)
+        lotto.config = config
+        lotto.accountInfo = {'account_data': {'Balance': 1e12}}
+        lotto.elGordo = None
+
+        start = time.perf_counter()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            lotto.processPrizes()
+
+        elapsed = time.perf_counter() - start
+        nprizes = Prize.select().count()
+
+        db.close()
+
+    return elapsed, nprizes
+
+
+if __name__ == '__main__':
+
+    with open('configTest.json', 'r') as configFile:
+        config = json.load(configFile)
+
+    print('{:>12} {:>8} {:>10} {:>14}'.format('participants', 'prizes', 'seconds', 'us/participant'))
+
+    for nparticipants in [1000, 10000, 100000]:
+        elapsed, nprizes = benchmark(nparticipants, config)
+        print('{:>12} {:>8} {:>10.3f} {:>14.2f}'.format(nparticipants, nprizes, elapsed, elapsed / nparticipants * 1e6))
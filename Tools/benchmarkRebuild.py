@@ -0,0 +1,105 @@
+# Measures Lotto.rebuildDBfromLedger on a synthetic cached history
+# Run from the repository root: python Tools/benchmarkRebuild.py [number of txs]
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import Lotto
+import TransactionCache
+from DBmodels import *
+from TransactionRecord import TransactionRecord
+
+
+def memoRecord(memo, account, destination, amount, hash, ledgerIndex):
+    return TransactionRecord(account, destination, None, str(int(amount * 1e6)), hash, ledgerIndex, 0, 'tesSUCCESS',
+                             [memo.encode().hex().upper()])
+
+
+def syntheticHistory(ntransactions, config):
+
+    # Received tickets of 1 to 5 XRP, with the prize, fee and donation payments sent every time a pool fills
+    lotto = config['accounts']['lotto']['address']
+    prizeValue = config['parameters']['prizes'][-1]
+
+    transactions = []
+    pool = []
+    balance = 0
+    prizeID = 0
+
+    while len(transactions) < ntransactions:
+
+        i = len(transactions)
+        amount = 1 + i % 5
+        tx = TransactionRecord('rPlayer{}'.format(i % 1000), lotto, None, str(amount * 1000000),
+                               '{:064X}'.format(i), i // 10, 0)
+
+        transactions.append(tx)
+        pool.append(tx)
+        balance += amount
+
+        if balance >= prizeValue:
+
+            prizeID += 1
+            memo = 'ZERPLOTTO.COM_PRIZE::Prize_id={}::First_included_TX={}::Last_included_TX={}::Winner_TX={}' \
+                   .format(prizeID, pool[0].hash, pool[-1].hash, pool[0].hash)
+
+            transactions.append(memoRecord(memo, lotto, pool[0].Account, balance * 0.9,
+                                           'P{:063X}'.format(prizeID), i // 10))
+            transactions.append(memoRecord('ZERPLOTTO.COM_FEE::Prize_id={}'.format(prizeID), lotto, 'rFees',
+                                           balance * 0.01, 'F{:063X}'.format(prizeID), i // 10))
+            transactions.append(memoRecord('ZERPLOTTO.COM_DONATION::Prize_id={}'.format(prizeID), lotto, 'rCharity',
+                                           balance * 0.09, 'D{:063X}'.format(prizeID), i // 10))
+            pool = []
+            balance = 0
+
+    return transactions
+
+
+if __name__ == '__main__':
+
+    ntransactions = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    with open('configTest.json', 'r') as configFile:
+        config = json.load(configFile)
+
+    config['accounts']['lotto']['address'] = 'rLotto'
+
+    transactions = syntheticHistory(ntransactions, config)
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        config['parameters']['database'] = os.path.join(directory, 'benchmark.db')
+
+        db.init(config['parameters']['database'])
+        db.create_tables([Prize, Fee, Donation, Devolution, Participant, Payment, LedgerTransaction])
+
+        # The rebuild replays the locally cached history
+        history = TransactionCache.TransactionCache(binary=True)
+
+        for batch in chunked(transactions, 1000):
+            history.store(config['accounts']['lotto']['address'], batch)
+
+        db.close()
+
+        # Offline Lotto
+        lotto = Lotto.Lotto.__new__(Lotto.Lotto)
+        lotto.config = config
+        lotto.history = history
+
+        start = time.perf_counter()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            lotto.rebuildDBfromLedger()
+
+        elapsed = time.perf_counter() - start
+
+        db.connect(reuse_if_open=True)
+        print('Rebuilt {} prizes from {} txs in {:.2f} seconds ({} tx/s)'
+              .format(Prize.select().count(), len(transactions), elapsed, round(len(transactions) / elapsed)))
+        db.close()
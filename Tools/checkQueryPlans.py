@@ -0,0 +1,60 @@
+# Checks that the main lotto lookups are answered through indexes instead of full table scans
+# Run from the repository root: python Tools/checkQueryPlans.py [database]
+# Without database a new one is created from the models, with it the schema is migrated first
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import Migrations
+from DBmodels import *
+
+
+def lookups():
+
+    return [('Participant by TXid', Participant.select().where(Participant.TXid == 'TX')),
+            ('Participants of a prize', Participant.select().where((Participant.prize == 100) &
+                                                                   (Participant.id >= 1)).order_by(Participant.id)),
+            ('Payments by status', Payment.select().where(Payment.status == 'PENDING')),
+            ('Payment by TXid', Payment.select().where(Payment.TXid == 'TX')),
+            ('Unsubmitted payments', Payment.select().where(Payment.TXid.is_null())),
+            ('Devolution by received TX', Devolution.select().where(Devolution.receivedTXid == 'TX')),
+            ('Prize by payment', Prize.select().where(Prize.paymentid == 1)),
+            ('Fees by payment', Fee.select().where(Fee.paymentid.in_([1, 2]))),
+            ('Donations by payment', Donation.select().where(Donation.paymentid.in_([1, 2]))),
+            ('Devolutions by payment', Devolution.select().where(Devolution.paymentid.in_([1, 2]))),
+            ('Cached txs since ledger', LedgerTransaction.select().where(LedgerTransaction.ledgerIndex >= 1))]
+
+
+def checkQueryPlans():
+
+    failures = 0
+
+    for name, query in lookups():
+
+        sql, params = query.sql()
+        plan = [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+
+        # Scans through an index are fine, plain scans read the whole table
+        scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step]
+
+        print('{:<30} {:<6} {}'.format(name, 'FAIL' if scans else 'OK', ' | '.join(plan)))
+        failures += bool(scans)
+
+    return failures
+
+
+if __name__ == '__main__':
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        db.init(sys.argv[1] if len(sys.argv) > 1 else os.path.join(directory, 'plans.db'))
+        Migrations.migrate()
+        db.create_tables([Prize, Fee, Donation, Devolution, Participant, Payment, PrizePool, LedgerTransaction, Notification])
+
+        failures = checkQueryPlans()
+
+        db.close()
+
+    sys.exit(1 if failures else 0)
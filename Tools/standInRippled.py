@@ -0,0 +1,275 @@
+# Minimal stand-in rippled to run the lotto locally, without any XRPL network
+# Run from the repository root: python Tools/standInRippled.py [port]
+# and point parameters.connection at ws://127.0.0.1:<port>
+# Serves the commands used by the lotto: fee, account_info, ledger_current, ledger, submit, tx, account_tx and subscribe
+# Signatures are not verified, txs are applied in sequence order when the next ledger closes
+import asyncio
+import json
+import os
+import sys
+import time
+import websockets
+from xrpl.core import binarycodec
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from TransactionRecord import transactionHash
+
+# Seconds between ledger closes, and drops every account starts with
+closeInterval = 1
+initialBalance = 1000000 * 1000000
+baseFee = 10
+
+# XRPL epoch offset of the close times
+rippleEpoch = 946684800
+
+
+class StandInLedger:
+
+    def __init__(self):
+        self.validatedLedger = 1000
+        self.closeTimes = {}
+        self.accounts = {}
+        self.queued = []
+        self.transactions = {}
+        self.history = []
+        self.subscribers = {}
+
+
+    def account(self, address):
+        return self.accounts.setdefault(address, {'Balance': initialBalance, 'Sequence': 1})
+
+
+    def submit(self, blob):
+
+        tx = binarycodec.decode(blob)
+        TXid = transactionHash(bytes.fromhex(blob))
+        sequence = self.account(tx['Account'])['Sequence']
+
+        if tx['Sequence'] < sequence:
+            return 'tefPAST_SEQ', TXid
+
+        if tx.get('LastLedgerSequence', self.validatedLedger + 1) <= self.validatedLedger:
+            return 'tefMAX_LEDGER', TXid
+
+        self.queued.append((tx, blob, TXid))
+
+        # Txs after a sequence gap are held until it is filled
+        return ('tesSUCCESS' if tx['Sequence'] == sequence else 'terPRE_SEQ'), TXid
+
+
+    def close(self):
+
+        ledgerIndex = self.validatedLedger + 1
+        closeTime = int(time.time()) - rippleEpoch
+        applied = []
+
+        # Held txs are applied as soon as their sequence is the next one, expired ones are dropped
+        progress = True
+
+        while progress:
+
+            progress = False
+
+            for entry in sorted(self.queued, key=lambda entry: entry[0]['Sequence']):
+
+                tx, blob, TXid = entry
+                source = self.account(tx['Account'])
+
+                if tx.get('LastLedgerSequence', ledgerIndex) < ledgerIndex:
+                    self.queued.remove(entry)
+                    continue
+
+                if tx['Sequence'] != source['Sequence']:
+                    continue
+
+                self.queued.remove(entry)
+                applied.append(self.apply(tx, blob, TXid, ledgerIndex, closeTime, len(applied)))
+                progress = True
+
+        self.validatedLedger = ledgerIndex
+        self.closeTimes[ledgerIndex] = closeTime
+
+        return applied
+
+
+    def apply(self, tx, blob, TXid, ledgerIndex, closeTime, transactionIndex):
+
+        source = self.account(tx['Account'])
+        amount = int(tx['Amount'])
+        fee = int(tx['Fee'])
+
+        source['Sequence'] += 1
+        source['Balance'] -= fee
+
+        if source['Balance'] < amount:
+            result = 'tecUNFUNDED_PAYMENT'
+        else:
+            result = 'tesSUCCESS'
+            source['Balance'] -= amount
+            self.account(tx['Destination'])['Balance'] += amount
+
+        meta = {'TransactionIndex': transactionIndex, 'TransactionResult': result, 'AffectedNodes': []}
+        entry = {'tx': dict(tx, hash=TXid, ledger_index=ledgerIndex, date=closeTime),
+                 'tx_blob': blob,
+                 'meta': meta,
+                 'ledger_index': ledgerIndex,
+                 'date': closeTime}
+
+        self.transactions[TXid] = entry
+        self.history.append(entry)
+
+        print('Ledger {}: {} {} drops from {} to {}'.format(ledgerIndex, result, amount, tx['Account'], tx['Destination']))
+
+        return entry
+
+
+    def accountTransactions(self, request):
+
+        account = request['account']
+        fromLedger = request.get('ledger_index_min', -1)
+        start = request.get('marker', 0)
+        limit = request.get('limit', 200)
+
+        entries = [entry for entry in self.history
+                   if account in (entry['tx']['Account'], entry['tx']['Destination']) and
+                      (fromLedger == -1 or entry['ledger_index'] >= fromLedger)]
+
+        page = entries[start:start + limit]
+
+        if request.get('binary'):
+            transactions = [{'tx_blob': entry['tx_blob'],
+                             'meta': binarycodec.encode(entry['meta']),
+                             'ledger_index': entry['ledger_index'],
+                             'validated': True} for entry in page]
+        else:
+            transactions = [{'tx': entry['tx'], 'meta': entry['meta'], 'validated': True} for entry in page]
+
+        result = {'account': account, 'transactions': transactions}
+
+        if start + limit < len(entries):
+            result['marker'] = start + limit
+
+        return result
+
+
+    def transaction(self, request):
+
+        entry = self.transactions.get(request['transaction'])
+
+        if entry is not None:
+            return dict(entry['tx'], meta=entry['meta'], validated=True), None
+
+        error = {'error': 'txnNotFound'}
+
+        if 'max_ledger' in request:
+            error['searched_all'] = request['max_ledger'] <= self.validatedLedger
+
+        return None, error
+
+
+    def handle(self, request):
+
+        # Returns (result, error) for a request
+        command = request['command']
+
+        if command == 'fee':
+            return {'drops': {'base_fee': str(baseFee), 'open_ledger_fee': str(baseFee)}}, None
+
+        if command == 'account_info':
+            account = self.account(request['account'])
+            return {'account_data': {'Account': request['account'],
+                                     'Balance': str(account['Balance']),
+                                     'Sequence': account['Sequence']}}, None
+
+        if command == 'ledger_current':
+            return {'ledger_current_index': self.validatedLedger + 1}, None
+
+        if command == 'ledger':
+
+            ledgerIndex = request.get('ledger_index', 'validated')
+            ledgerIndex = self.validatedLedger if ledgerIndex == 'validated' else int(ledgerIndex)
+
+            if ledgerIndex not in self.closeTimes and ledgerIndex != self.validatedLedger:
+                return None, {'error': 'lgrNotFound'}
+
+            return {'ledger_index': ledgerIndex,
+                    'ledger': {'ledger_index': str(ledgerIndex), 'close_time': self.closeTimes.get(ledgerIndex, 0)},
+                    'validated': True}, None
+
+        if command == 'submit':
+            engineResult, TXid = self.submit(request['tx_blob'])
+            return {'engine_result': engineResult, 'tx_json': {'hash': TXid}}, None
+
+        if command == 'tx':
+            return self.transaction(request)
+
+        if command == 'account_tx':
+            return self.accountTransactions(request), None
+
+        return None, {'error': 'unknownCmd'}
+
+
+async def serve(ledger, websocket, *args):
+
+    async for message in websocket:
+
+        request = json.loads(message)
+
+        if request['command'] == 'subscribe':
+            for account in request.get('accounts', []):
+                ledger.subscribers.setdefault(account, set()).add(websocket)
+            result, error = {}, None
+        else:
+            result, error = ledger.handle(request)
+
+        response = {'id': request.get('id'), 'type': 'response'}
+
+        if error is None:
+            response.update(status='success', result=result)
+        else:
+            response.update(status='error', **error)
+
+        await websocket.send(json.dumps(response))
+
+    for subscribers in ledger.subscribers.values():
+        subscribers.discard(websocket)
+
+
+async def closeLedgers(ledger):
+
+    # Validated txs are streamed to the connections subscribed to their accounts
+    while True:
+
+        await asyncio.sleep(closeInterval)
+
+        for entry in ledger.close():
+
+            message = json.dumps({'type': 'transaction',
+                                  'validated': True,
+                                  'ledger_index': entry['ledger_index'],
+                                  'transaction': entry['tx'],
+                                  'meta': entry['meta'],
+                                  'engine_result': entry['meta']['TransactionResult']})
+
+            accounts = {entry['tx']['Account'], entry['tx']['Destination']}
+
+            for websocket in set().union(*[ledger.subscribers.get(account, set()) for account in accounts]):
+                try:
+                    await websocket.send(message)
+                except websockets.exceptions.ConnectionClosed:
+                    pass
+
+
+async def main(port):
+
+    ledger = StandInLedger()
+
+    async with websockets.serve(lambda websocket, *args: serve(ledger, websocket, *args), '127.0.0.1', port):
+        print('Stand-in rippled listening on ws://127.0.0.1:{}'.format(port))
+        await closeLedgers(ledger)
+
+
+if __name__ == '__main__':
+
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 6006))
@@ -0,0 +1,117 @@
+from peewee import *
+from DBmodels import *
+import json
+import TransactionRecord
+
+
+# Append-only local copy of the account transaction history
+# History is kept contiguous since the account activation, so only the txs past the last cached ledger are downloaded
+# Without a ledger the cache works offline, serving only the already stored txs
+# In binary mode txs are downloaded and served as compact TransactionRecords
+class TransactionCache:
+
+    def __init__(self, ledger=None, binary=False):
+        self.ledger = ledger
+        self.binary = binary
+
+
+    def getLastCachedLedger(self, address):
+        return LedgerTransaction.select(fn.MAX(LedgerTransaction.ledgerIndex)) \
+                                .where(LedgerTransaction.account == address) \
+                                .scalar()
+
+
+    @staticmethod
+    def serialize(tx):
+
+        if isinstance(tx, TransactionRecord.TransactionRecord):
+            return {'tx': tx.toDict()}
+
+        return tx
+
+
+    def load(self, data):
+
+        tx = json.loads(data)
+
+        if self.binary:
+            return TransactionRecord.TransactionRecord.fromDict(tx['tx'])
+
+        return tx
+
+
+    def store(self, address, transactions):
+
+        rows = [{'account': address,
+                 'hash': tx['tx']['hash'],
+                 'ledgerIndex': tx['tx']['ledger_index'],
+                 'data': json.dumps(self.serialize(tx), separators=(',', ':'))} for tx in transactions]
+
+        if rows:
+            with db.atomic():
+                LedgerTransaction.insert_many(rows).on_conflict_ignore().execute()
+
+
+    def iterAccountTransactions(self, address, ledger_index_min=-1):
+
+        lastCachedLedger = self.getLastCachedLedger(address)
+
+        # Cached txs first
+        query = LedgerTransaction.select().where(LedgerTransaction.account == address)
+
+        if ledger_index_min != -1:
+            query = query.where(LedgerTransaction.ledgerIndex >= ledger_index_min)
+
+        for row in query.order_by(LedgerTransaction.id).iterator():
+            yield self.load(row.data)
+
+        if self.ledger is None:
+            return
+
+        for tx in self.fetchDelta(address, lastCachedLedger):
+            if ledger_index_min == -1 or tx['tx']['ledger_index'] >= ledger_index_min:
+                yield tx
+
+
+    def fetchDelta(self, address, lastCachedLedger):
+
+        # Download starts again from the last cached ledger as it could have been stored partially
+        if lastCachedLedger is None:
+            fetchFrom = -1
+            cachedTXs = set()
+        else:
+            fetchFrom = lastCachedLedger
+            cachedTXs = {row.hash for row in LedgerTransaction.select(LedgerTransaction.hash)
+                                                              .where((LedgerTransaction.account == address) &
+                                                                     (LedgerTransaction.ledgerIndex == lastCachedLedger))}
+
+        for transactions, _ in self.ledger.getAccountTransactionPages(address, fetchFrom, binary=self.binary):
+
+            transactions = [tx for tx in transactions if tx['tx']['hash'] not in cachedTXs]
+            self.store(address, transactions)
+
+            yield from transactions
+
+
+    def update(self, address):
+
+        # Download the txs past the last cached ledger
+        if self.ledger is not None:
+            for _ in self.fetchDelta(address, self.getLastCachedLedger(address)):
+                pass
+
+
+    def getTransactions(self, TXids):
+
+        # Cached txs are resolved locally, the rest are requested to the server
+        transactions = {}
+
+        for row in LedgerTransaction.select().where(LedgerTransaction.hash.in_(TXids)):
+            transactions[row.hash] = json.loads(row.data)['tx']
+
+        missingTXs = [TXid for TXid in TXids if TXid not in transactions]
+
+        if missingTXs and self.ledger is not None:
+            transactions.update(self.ledger.getTransactions(missingTXs))
+
+        return transactions
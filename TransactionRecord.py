@@ -0,0 +1,276 @@
+import hashlib
+
+
+# Minimal decoder for the XRPL binary format, only the fields used by the lotto are kept
+# See https://xrpl.org/serialization.html
+
+rippleAlphabet = 'rpshnaf39wBUDNEGHJKLM4PQRST7VWXYZ2bcdeCg65jkm8oFqi1tuvAxyz'
+
+# Field sizes by type code, None for variable length (length prefixed) types
+typeSizes = {1: 2, 2: 4, 3: 8, 4: 16, 5: 32, 7: None, 8: None, 9: 12, 10: 4, 11: 8, 16: 1, 17: 20, 19: None}
+
+# (type code, field code) of the decoded fields
+fieldNames = {(2, 14): 'DestinationTag',
+              (6, 1): 'Amount',
+              (8, 1): 'Account',
+              (8, 3): 'Destination',
+              (7, 13): 'MemoData',
+              (15, 9): 'Memos'}
+
+objectEndMarker = (14, 1)
+arrayEndMarker = (15, 1)
+
+# Transaction hashes are the SHA-512Half of the 'TXN\0' prefix plus the signed blob
+transactionHashPrefix = bytes.fromhex('54584E00')
+
+# TransactionResult (UInt8, field 3) sorts after every other metadata field, so it closes the serialized metadata
+transactionResultField = bytes.fromhex('0310')
+
+# Result names of the codes a payment can end with, see https://xrpl.org/tec-codes.html
+resultNames = {0: 'tesSUCCESS',
+               101: 'tecPATH_PARTIAL',
+               104: 'tecUNFUNDED_PAYMENT',
+               124: 'tecNO_DST',
+               125: 'tecNO_DST_INSUF_XRP',
+               128: 'tecPATH_DRY',
+               143: 'tecDST_TAG_NEEDED'}
+
+
+def transactionHash(blob):
+    return hashlib.sha512(transactionHashPrefix + blob).digest()[:32].hex().upper()
+
+
+def transactionResult(meta):
+
+    meta = bytes.fromhex(meta)
+
+    if meta[-3:-1] != transactionResultField:
+        raise ValueError('Unexpected metadata layout')
+
+    return resultNames.get(meta[-1], 'tec{}'.format(meta[-1]))
+
+
+def encodeAccountID(accountID):
+
+    payload = b'\x00' + accountID
+    payload += hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+
+    number = int.from_bytes(payload, 'big')
+    encoded = ''
+
+    while number > 0:
+        number, remainder = divmod(number, 58)
+        encoded = rippleAlphabet[remainder] + encoded
+
+    # Leading zero bytes are encoded as the first alphabet char
+    leadingZeros = len(payload) - len(payload.lstrip(b'\x00'))
+
+    return rippleAlphabet[0] * leadingZeros + encoded
+
+
+class BinaryParser:
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+
+    def read(self, size):
+        chunk = self.data[self.position:self.position + size]
+        self.position += size
+        return chunk
+
+
+    def end(self):
+        return self.position >= len(self.data)
+
+
+    def readFieldID(self):
+
+        byte = self.read(1)[0]
+        typeCode = byte >> 4
+        fieldCode = byte & 0x0F
+
+        if typeCode == 0:
+            typeCode = self.read(1)[0]
+
+        if fieldCode == 0:
+            fieldCode = self.read(1)[0]
+
+        return typeCode, fieldCode
+
+
+    def readLength(self):
+
+        byte1 = self.read(1)[0]
+
+        if byte1 <= 192:
+            return byte1
+
+        byte2 = self.read(1)[0]
+
+        if byte1 <= 240:
+            return 193 + (byte1 - 193) * 256 + byte2
+
+        byte3 = self.read(1)[0]
+
+        return 12481 + (byte1 - 241) * 65536 + byte2 * 256 + byte3
+
+
+    def readAmount(self):
+
+        # Native amounts are 8 bytes: not-XRP bit, sign bit and 62 bits of drops
+        # Issued amounts are 48 bytes and are not decoded
+        value = self.read(8)
+
+        if value[0] & 0x80:
+            self.read(40)
+            return None
+
+        return str(int.from_bytes(value, 'big') & 0x3FFFFFFFFFFFFFFF)
+
+
+    def readObject(self, endMarker=None):
+
+        fields = {}
+
+        while not self.end():
+
+            field = self.readFieldID()
+            typeCode = field[0]
+
+            if field == endMarker:
+                break
+
+            # Fields are sorted by type code and the last decoded one is an STArray
+            if endMarker is None and typeCode > 15:
+                break
+
+            if typeCode == 2 or typeCode == 1:
+                value = int.from_bytes(self.read(typeSizes[typeCode]), 'big')
+            elif typeCode == 6:
+                value = self.readAmount()
+            elif typeCode == 8:
+                value = encodeAccountID(self.read(self.readLength()))
+            elif typeCode == 7:
+                value = self.read(self.readLength()).hex().upper()
+            elif typeCode == 14:
+                value = self.readObject(objectEndMarker)
+            elif typeCode == 15:
+                value = self.readArray()
+            elif typeCode in typeSizes:
+                size = typeSizes[typeCode]
+                self.read(self.readLength() if size is None else size)
+                continue
+            else:
+                raise ValueError('Unsupported field type {}'.format(typeCode))
+
+            if field in fieldNames:
+                fields[fieldNames[field]] = value
+
+        return fields
+
+
+    def readArray(self):
+
+        elements = []
+
+        while not self.end():
+
+            field = self.readFieldID()
+
+            if field == arrayEndMarker:
+                break
+
+            elements.append(self.readObject(objectEndMarker))
+
+        return elements
+
+
+class TransactionRecord:
+    # Compact stand-in for an account_tx entry: tx['Account'], entry['tx'] and entry['meta']['TransactionResult'] work on a record
+
+    __slots__ = ('Account', 'Destination', 'DestinationTag', 'Amount', 'hash', 'ledger_index', 'date', 'TransactionResult', 'memoData')
+
+    fields = __slots__[:-1]
+
+
+    def __init__(self, Account, Destination, DestinationTag, Amount, hash, ledger_index, date, TransactionResult=None, memoData=()):
+        self.Account = Account
+        self.Destination = Destination
+        self.DestinationTag = DestinationTag
+        self.Amount = Amount
+        self.hash = hash
+        self.ledger_index = ledger_index
+        self.date = date
+        self.TransactionResult = TransactionResult
+        self.memoData = tuple(memoData)
+
+
+    @classmethod
+    def fromBlob(cls, blob, ledger_index, date, meta=None):
+
+        blob = bytes.fromhex(blob)
+        fields = BinaryParser(blob).readObject()
+
+        memoData = [memo['MemoData'] for memo in fields.get('Memos', ()) if 'MemoData' in memo]
+
+        return cls(fields.get('Account'),
+                   fields.get('Destination'),
+                   fields.get('DestinationTag'),
+                   fields.get('Amount'),
+                   transactionHash(blob),
+                   ledger_index,
+                   date,
+                   transactionResult(meta) if meta else None,
+                   memoData)
+
+
+    @classmethod
+    def fromDict(cls, data):
+
+        memoData = [memo['Memo']['MemoData'] for memo in data.get('Memos', ()) if 'MemoData' in memo['Memo']]
+
+        return cls(*[data.get(field) for field in cls.fields], memoData)
+
+
+    def toDict(self):
+
+        data = {field: getattr(self, field) for field in self.fields if getattr(self, field) is not None}
+
+        if self.memoData:
+            data['Memos'] = self['Memos']
+
+        return data
+
+
+    def __getitem__(self, key):
+
+        if key == 'tx':
+            return self
+
+        # Records cached before results were decoded have no metadata
+        if key == 'meta' and self.TransactionResult is not None:
+            return {'TransactionResult': self.TransactionResult}
+
+        if key == 'Memos' and self.memoData:
+            return [{'Memo': {'MemoData': memoData}} for memoData in self.memoData]
+
+        if key in self.fields and getattr(self, key) is not None:
+            return getattr(self, key)
+
+        raise KeyError(key)
+
+
+    def __contains__(self, key):
+
+        try:
+            self[key]
+        except KeyError:
+            return False
+
+        return True
+
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
@@ -1,15 +1,22 @@
 import Lotto
 import json
+import sys
 
 testing = True
 
-# Load configuration
-configFilePath = 'configTest.json' if testing else 'config.json'
+# Guarded, so the rebuild worker processes can import this script
+if __name__ == "__main__":
 
-with open(configFilePath, 'r') as configFile:
+    # Rebuild from the local transaction cache only
+    offline = '--offline' in sys.argv
 
-    config = json.load(configFile) # TODO: validate json scheme
+    # Load configuration
+    configFilePath = 'configTest.json' if testing else 'config.json'
 
-    lotto = Lotto.Lotto(config)
+    with open(configFilePath, 'r') as configFile:
 
-    lotto.rebuildDBfromLedger()
\ No newline at end of file
+        config = json.load(configFile) # TODO: validate json scheme
+
+        lotto = Lotto.Lotto(config, offline=offline)
+
+        lotto.rebuildDBfromLedger()
\ No newline at end of file